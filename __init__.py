@@ -2,6 +2,8 @@ from .nodes.cubemap_to_spherical import NODE_CLASS_MAPPINGS as CUBEMAP_NODE_CLAS
 from .nodes.cubemap_to_spherical import NODE_DISPLAY_NAME_MAPPINGS as CUBEMAP_NODE_DISPLAY_NAME_MAPPINGS
 from .nodes.spherical_to_cubemap import NODE_CLASS_MAPPINGS as SPHERICAL_NODE_CLASS_MAPPINGS
 from .nodes.spherical_to_cubemap import NODE_DISPLAY_NAME_MAPPINGS as SPHERICAL_NODE_DISPLAY_NAME_MAPPINGS
+from .nodes.panorama_views import NODE_CLASS_MAPPINGS as PANORAMA_VIEWS_NODE_CLASS_MAPPINGS
+from .nodes.panorama_views import NODE_DISPLAY_NAME_MAPPINGS as PANORAMA_VIEWS_NODE_DISPLAY_NAME_MAPPINGS
 from .nodes.telegram import NODE_CLASS_MAPPINGS as TELEGRAM_NODE_CLASS_MAPPINGS
 from .nodes.telegram import NODE_DISPLAY_NAME_MAPPINGS as TELEGRAM_NODE_DISPLAY_NAME_MAPPINGS   
 from .nodes.animated_seed import NODE_CLASS_MAPPINGS as ANIMATED_SEED_NODE_CLASS_MAPPINGS
@@ -12,6 +14,7 @@ from .nodes.social_media_handle import NODE_DISPLAY_NAME_MAPPINGS as SOCIAL_MEDI
 NODE_CLASS_MAPPINGS = {
     **CUBEMAP_NODE_CLASS_MAPPINGS,
     **SPHERICAL_NODE_CLASS_MAPPINGS,
+    **PANORAMA_VIEWS_NODE_CLASS_MAPPINGS,
     **TELEGRAM_NODE_CLASS_MAPPINGS,
     **ANIMATED_SEED_NODE_CLASS_MAPPINGS,
     **SOCIAL_MEDIA_HANDLE_NODE_CLASS_MAPPINGS,
@@ -21,6 +24,7 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     **CUBEMAP_NODE_DISPLAY_NAME_MAPPINGS,
     **SPHERICAL_NODE_DISPLAY_NAME_MAPPINGS,
+    **PANORAMA_VIEWS_NODE_DISPLAY_NAME_MAPPINGS,
     **TELEGRAM_NODE_DISPLAY_NAME_MAPPINGS,
     **ANIMATED_SEED_NODE_DISPLAY_NAME_MAPPINGS,
     **SOCIAL_MEDIA_HANDLE_NODE_DISPLAY_NAME_MAPPINGS,
@@ -0,0 +1,114 @@
+import gc
+import importlib
+import math
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+
+PACKAGE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# The node modules use relative imports, so they are loaded as part of a stand-in package
+PACKAGE_NAME = "cozy_toolbelt"
+
+
+def load_node_module(name):
+    """ imports nodes/<name>.py without ComfyUI and without running the package __init__ """
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [PACKAGE_DIR]
+        sys.modules[PACKAGE_NAME] = package
+
+        nodes = types.ModuleType(f"{PACKAGE_NAME}.nodes")
+        nodes.__path__ = [os.path.join(PACKAGE_DIR, "nodes")]
+        sys.modules[f"{PACKAGE_NAME}.nodes"] = nodes
+    return importlib.import_module(f"{PACKAGE_NAME}.nodes.{name}")
+
+
+def time_call(fn, repeat=5, warmup=1):
+    """ wall clock seconds of `repeat` calls after `warmup` untimed calls """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        "repeat": repeat,
+    }
+
+
+def memory_call(fn):
+    """ peak memory and allocation count of a single call
+
+    torch allocations are taken from the profiler's memory events, numpy and python
+    allocations from tracemalloc, both relative to what was live before the call """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+        _, python_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    ## replay the allocations and frees in the order they happened
+    live = peak = allocations = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        usage = event.self_cpu_memory_usage
+        if usage > 0:
+            allocations += 1
+        live += usage
+        peak = max(peak, live)
+
+    return {
+        "torch_peak_bytes": peak,
+        "torch_allocations": allocations,
+        "python_peak_bytes": python_peak,
+    }
+
+
+def psnr(result, reference, peak=1.0):
+    mse = torch.mean((result.double() - reference.double()) ** 2).item()
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(peak ** 2 / mse)
+
+
+def max_rss_bytes():
+    ## ru_maxrss is in kilobytes on linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
@@ -0,0 +1,469 @@
+""" CPU benchmarks and accuracy checks for the cozy-toolbelt nodes, results are written as JSON
+
+    python benchmarks/run_benchmarks.py --quick --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## benchmarks are CPU only, hide any GPU before torch is imported
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import torch
+
+from harness import PACKAGE_DIR, environment, load_node_module, max_rss_bytes, memory_call, psnr, time_call
+
+
+# (equirect width, batch size) of every projection case, the equirect is width x width / 2
+# and the cube faces are width / 4 on a side
+PROJECTION_SIZES = [(1024, 1), (1024, 4), (2048, 1), (2048, 4), (4096, 1)]
+QUICK_PROJECTION_SIZES = [(512, 1), (1024, 2)]
+FILTERS = ["nearest", "bilinear", "bicubic"]
+
+# Maximum absolute error of the reduced precision compute dtypes against float32, as documented in the README,
+# for the pixelwise normalize modes and for the stretching ones
+PRECISION_BOUNDS = {
+    "fp16": {"clamp": 2.5e-4, "none": 2.5e-4, "minmax": 1e-3, "per-channel": 1e-3},
+    "bf16": {"clamp": 2e-3, "none": 2e-3, "minmax": 8e-3, "per-channel": 8e-3},
+}
+
+ROUND_TRIP_WIDTHS = [1024, 2048]
+QUICK_ROUND_TRIP_WIDTHS = [512]
+
+# (image size, batch size) of the burn in cases
+HANDLE_SIZES = [(512, 1), (1024, 1), (1024, 16), (2048, 4)]
+QUICK_HANDLE_SIZES = [(512, 1), (512, 8)]
+
+# (frame size, frame count, x264 preset) of the Telegram cases
+TELEGRAM_CASES = [(512, 16, "ultrafast"), (512, 64, "medium"), (1024, 32, "veryfast")]
+QUICK_TELEGRAM_CASES = [(256, 8, "ultrafast")]
+
+# Modules that must not be imported while ComfyUI registers the nodes
+HEAVY_MODULES = ["requests", "dotenv", "PIL"]
+
+# Imports the package the way ComfyUI does, in a fresh interpreter, and reports what it cost
+STARTUP_SCRIPT = """
+import importlib.util, json, os, sys, time
+import numpy, torch  # already loaded by ComfyUI before any custom node
+
+opened = []
+sys.addaudithook(lambda event, args: opened.append(str(args[0])) if event == "open" else None)
+
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("cozy_toolbelt", os.path.join(sys.argv[1], "__init__.py"), submodule_search_locations=[sys.argv[1]])
+package = importlib.util.module_from_spec(spec)
+sys.modules["cozy_toolbelt"] = package
+spec.loader.exec_module(package)
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    "import_s": elapsed,
+    "nodes": len(package.NODE_CLASS_MAPPINGS),
+    "modules": [name for name in sys.argv[2:] if name in sys.modules],
+    "files": [path for path in opened if not path.endswith((".py", ".pyc", ".so"))],
+}))
+"""
+
+
+def projection_cache():
+    return load_node_module("projection_cache").PROJECTION_CACHE
+
+
+def spherical_test_image(width, height, batch_size=1):
+    """ a smooth colour field over the sphere, continuous across the seam and the poles """
+    v = (torch.arange(height) + 0.5) / height * math.pi
+    u = (torch.arange(width) + 0.5) / width * 2 * math.pi - math.pi
+    phi, theta = torch.meshgrid(v, u, indexing="ij")
+    x, y, z = torch.sin(phi) * torch.cos(theta), torch.sin(phi) * torch.sin(theta), torch.cos(phi)
+    image = torch.stack([
+        0.5 + 0.4 * torch.sin(2 * x + y),
+        0.5 + 0.4 * torch.cos(3 * y - z),
+        0.5 + 0.4 * torch.sin(x * z + 2 * z),
+    ], dim=-1)
+    return image.expand(batch_size, -1, -1, -1).contiguous()
+
+
+def measure(fn, pixels, repeat):
+    """ timing, throughput and memory of a node call that produces `pixels` output pixels """
+    timing = time_call(fn, repeat=repeat)
+    return {
+        "time": timing,
+        "throughput_mpix_s": pixels / timing["median_s"] / 1e6,
+        "memory": memory_call(fn),
+    }
+
+
+def bench_spherical_to_cubemap(quick, repeat):
+    node = load_node_module("spherical_to_cubemap").SphericalToCubemapV2()
+    for width, batch_size in QUICK_PROJECTION_SIZES if quick else PROJECTION_SIZES:
+        image = spherical_test_image(width, width // 2, batch_size)
+        face_size = width // 4
+        for filter in FILTERS:
+            convert = lambda: node.convert(image, face_size, filter=filter)
+
+            ## the first call of a geometry builds its projection map
+            projection_cache().clear()
+            cold = time_call(convert, repeat=1, warmup=0)
+
+            result = measure(convert, batch_size * 6 * face_size ** 2, repeat)
+            result["time"]["cold_s"] = cold["median_s"]
+            yield f"{filter} {width}x{width // 2} b{batch_size}", {
+                "filter": filter, "width": width, "height": width // 2, "face_size": face_size, "batch_size": batch_size,
+            }, result
+
+
+def bench_cubemap_to_spherical(quick, repeat):
+    to_cubemap = load_node_module("spherical_to_cubemap").SphericalToCubemapV2()
+    node = load_node_module("cubemap_to_spherical").CubemapToSphericalV2()
+    for width, batch_size in QUICK_PROJECTION_SIZES if quick else PROJECTION_SIZES:
+        face_size = width // 4
+        faces = to_cubemap.convert(spherical_test_image(width, width // 2, batch_size), face_size)[:6]
+        for filter in FILTERS:
+            ## repeated calls with the same faces would only return the last result
+            convert = lambda: node.convert(*faces, width, width // 2, 5.0, 1.0, filter=filter, incremental=False)
+
+            projection_cache().clear()
+            cold = time_call(convert, repeat=1, warmup=0)
+
+            result = measure(convert, batch_size * width * (width // 2), repeat)
+            result["time"]["cold_s"] = cold["median_s"]
+            yield f"{filter} {width}x{width // 2} b{batch_size}", {
+                "filter": filter, "width": width, "height": width // 2, "face_size": face_size, "batch_size": batch_size,
+            }, result
+
+        ## the same cubemap read in place from an atlas
+        atlas = to_cubemap.convert(spherical_test_image(width, width // 2, batch_size), face_size, layout="horizontal_cross")[7]
+        convert = lambda: node.convert(output_width=width, output_height=width // 2, edge_width=5.0, mask_blur=1.0, layout="horizontal_cross", cubemap_atlas=atlas, incremental=False)
+        yield f"nearest {width}x{width // 2} b{batch_size} cross", {
+            "filter": "nearest", "width": width, "height": width // 2, "face_size": face_size, "batch_size": batch_size, "layout": "horizontal_cross",
+        }, measure(convert, batch_size * width * (width // 2), repeat)
+
+        ## an inpainting loop that regenerates the front face on every call
+        for filter in FILTERS:
+            versions = [faces[0], 1 - faces[0]]
+            def convert():
+                versions.reverse()
+                return node.convert(versions[0], *faces[1:], width, width // 2, 5.0, 1.0, filter=filter, incremental=True)
+
+            yield f"{filter} {width}x{width // 2} b{batch_size} front changed", {
+                "filter": filter, "width": width, "height": width // 2, "face_size": face_size, "batch_size": batch_size, "changed_faces": 1,
+            }, measure(convert, batch_size * width * (width // 2), repeat)
+
+
+def bench_round_trip(quick, repeat):
+    """ equirect -> cubemap -> equirect, the PSNR against the original measures the geometry and filtering """
+    to_cubemap = load_node_module("spherical_to_cubemap").SphericalToCubemapV2()
+    to_spherical = load_node_module("cubemap_to_spherical").CubemapToSphericalV2()
+    for width in QUICK_ROUND_TRIP_WIDTHS if quick else ROUND_TRIP_WIDTHS:
+        height = width // 2
+        image = spherical_test_image(width, height)
+        for face_size in (width // 4, width // 2):
+            for filter in FILTERS:
+                def round_trip():
+                    faces = to_cubemap.convert(image, face_size, filter=filter)[:6]
+                    return to_spherical.convert(*faces, width, height, 5.0, 1.0, filter=filter, incremental=False)[0]
+
+                result = {"psnr_db": psnr(round_trip(), image), "time": time_call(round_trip, repeat=repeat, warmup=0)}
+                yield f"{filter} {width}x{height} face{face_size}", {
+                    "filter": filter, "width": width, "height": height, "face_size": face_size,
+                }, result
+
+
+def bench_precision(quick, repeat):
+    """ the error of the fp16 and bf16 compute dtypes against float32, checked against the documented bounds """
+    to_cubemap = load_node_module("spherical_to_cubemap").SphericalToCubemapV2()
+    to_spherical = load_node_module("cubemap_to_spherical").CubemapToSphericalV2()
+    width, batch_size = QUICK_PROJECTION_SIZES[-1] if quick else PROJECTION_SIZES[1]
+    image = spherical_test_image(width, width // 2, batch_size)
+    faces = to_cubemap.convert(image, width // 4)[:6]
+
+    for compute_dtype, bounds in PRECISION_BOUNDS.items():
+        ## spherical to cubemap has no normalize step, it is held to the clamp bound
+        cases = [("spherical_to_cubemap", "clamp", lambda dtype: torch.cat(to_cubemap.convert(image, width // 4, compute_dtype=dtype)[:6]))]
+        for normalize in bounds:
+            cases.append(("cubemap_to_spherical", normalize, lambda dtype, normalize=normalize: to_spherical.convert(
+                *faces, width, width // 2, 5.0, 1.0, normalize=normalize, compute_dtype=dtype, incremental=False)[0]))
+
+        for node, normalize, convert in cases:
+            reference = convert("fp32")
+            result = {"time": time_call(lambda: convert(compute_dtype), repeat=repeat)}
+            result["max_abs_error"] = (convert(compute_dtype) - reference).abs().max().item()
+            if result["max_abs_error"] > bounds[normalize]:
+                result["failed"] = f"max error {result['max_abs_error']:.2e} is over the documented {bounds[normalize]:.1e}"
+            yield f"{node} {compute_dtype} {normalize}", {
+                "node": node, "compute_dtype": compute_dtype, "normalize": normalize, "width": width, "batch_size": batch_size, "bound": bounds[normalize],
+            }, result
+
+
+def bench_panorama_views(quick, repeat):
+    module = load_node_module("panorama_views")
+    nodes = {"perspective": module.PanoramaToPerspective(), "fisheye": module.PanoramaToFisheye()}
+    for width, batch_size in QUICK_PROJECTION_SIZES if quick else PROJECTION_SIZES:
+        image = spherical_test_image(width, width // 2, batch_size)
+        view_size = width // 2
+        for name, node in nodes.items():
+            for filter in FILTERS:
+                convert = lambda: node.convert(image, view_size, view_size, 90.0, 30.0, 15.0, 0.0, filter=filter)
+                yield f"{name} {filter} {width}x{width // 2} b{batch_size}", {
+                    "view": name, "filter": filter, "width": width, "height": width // 2, "view_size": view_size, "batch_size": batch_size,
+                }, measure(convert, batch_size * view_size ** 2, repeat)
+
+
+def bench_social_media_handle(quick, repeat):
+    ## a generated logo in a throwaway asset directory keeps the logo path offline
+    asset_dir = tempfile.mkdtemp()
+    os.environ["COZY_ASSET_DIR"] = asset_dir
+    try:
+        from PIL import Image
+        os.makedirs(os.path.join(asset_dir, "logos"))
+        Image.new("RGBA", (256, 256), (40, 120, 220, 255)).save(os.path.join(asset_dir, "logos", "x.com.png"))
+
+        node = load_node_module("social_media_handle").BurnSocialMediaHandle()
+        for size, batch_size in QUICK_HANDLE_SIZES if quick else HANDLE_SIZES:
+            image = torch.rand(batch_size, size, size, 3)
+            for add_logo in (False, True):
+                burn = lambda: node.burn_handle(image, "cozy_toolbelt", "x.com", "bottom_right", 24, 0.5, add_logo)
+                yield f"{size}x{size} b{batch_size}{' logo' if add_logo else ''}", {
+                    "size": size, "batch_size": batch_size, "add_logo": add_logo,
+                }, measure(burn, batch_size * size * size, repeat)
+    finally:
+        shutil.rmtree(asset_dir, ignore_errors=True)
+
+
+class TelegramStandIn(BaseHTTPRequestHandler):
+    """ answers Bot API calls after reading the whole upload, with the scripted (status, body) replies
+    queued in server.replies first and success after that """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        replies = getattr(self.server, "replies", [])
+        status, reply = replies.pop(0) if replies else (200, {"ok": True, "result": {}})
+        self.server.calls = getattr(self.server, "calls", 0) + 1
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_telegram(quick, repeat):
+    if shutil.which("ffmpeg") is None:
+        yield "encode", {}, {"skipped": "ffmpeg not found on PATH"}
+        return
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TelegramStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+    try:
+        telegram = load_node_module("telegram")
+        node = telegram.CombineAndSendToTelegram()
+        for size, frame_count, preset in QUICK_TELEGRAM_CASES if quick else TELEGRAM_CASES:
+            images = torch.rand(1, size, size, 3).expand(frame_count, -1, -1, -1) * torch.linspace(0, 1, frame_count).view(-1, 1, 1, 1)
+            params = {"size": size, "frame_count": frame_count, "preset": preset}
+            encoder = {"preset": preset, "crf": 23, "max_file_size_mb": 0.0, "max_dimension": 0, "threads": 0}
+
+            temp_dir = tempfile.mkdtemp()
+            try:
+                output_file = os.path.join(temp_dir, "output.mp4")
+                encode = lambda: node.encode_video(images, 10, output_file, encoder)
+                result = measure(encode, frame_count * size * size, repeat)
+                result["video_bytes"] = os.path.getsize(output_file)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            yield f"encode {size}x{size} x{frame_count} {preset}", params, result
+
+            ## encoding plus the upload to the local stand-in server
+            send = lambda: node.process_and_send(images, 10, "benchmark", bot_token="benchmark", chat_id="0", preset=preset)
+            yield f"send {size}x{size} x{frame_count} {preset}", params, {"time": time_call(send, repeat=repeat, warmup=0)}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_telegram_delivery(quick, repeat):
+    """ the retries of the delivery worker against scripted failures of the stand-in server """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TelegramStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        delivery = load_node_module("telegram_delivery")
+        backoff = 0.05
+        cases = [
+            ## (case, scripted replies, max retries, expected calls, expected final status, least seconds spent waiting)
+            ("429 retry_after", [(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 1}})], 5, 2, 200, 1.0),
+            ("5xx backoff", [(502, {"ok": False}), (503, {"ok": False})], 5, 3, 200, backoff * 3),
+            ("5xx gives up", [(500, {"ok": False})] * 3, 2, 3, 500, backoff * 3),
+        ]
+        for case, replies, max_retries, expected_calls, expected_status, least_seconds in cases:
+            worker = delivery.TelegramDeliveryWorker(api_url=f"http://127.0.0.1:{server.server_port}", max_retries=max_retries, backoff=backoff)
+            server.replies, server.calls = list(replies), 0
+            start = time.perf_counter()
+            response = worker.send("benchmark", "sendMessage", {"chat_id": "0", "text": "retry"}, {})
+            elapsed = time.perf_counter() - start
+
+            result = {"time": {"median_s": elapsed, "min_s": elapsed, "max_s": elapsed, "repeat": 1}, "calls": server.calls, "status": response.status_code}
+            if (server.calls, response.status_code) != (expected_calls, expected_status) or elapsed < least_seconds:
+                result["failed"] = f"expected {expected_calls} calls ending in {expected_status} after at least {least_seconds:.2f} s, " \
+                                   f"got {server.calls} calls ending in {response.status_code} after {elapsed:.2f} s"
+            yield case, {"max_retries": max_retries, "backoff": backoff}, result
+
+        ## the worker thread and synchronous sends each get their own session
+        worker = delivery.TelegramDeliveryWorker(api_url=f"http://127.0.0.1:{server.server_port}")
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(worker.session))
+        thread.start()
+        thread.join()
+        result = {"time": time_call(lambda: worker.session, repeat=repeat)}
+        if sessions[0] is worker.session:
+            result["failed"] = "threads share one requests.Session"
+        yield "session per thread", {}, result
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_animated_seed(quick, repeat):
+    node = load_node_module("animated_seed").AnimatedSeedBatch()
+    frame_count = 1000 if quick else 100000
+    for mode in ("increment", "randomize"):
+        generate = lambda: node.generate_seeds("0-100000:24, 7, 13", 0, frame_count, mode, 1234)
+        yield f"batch {mode} x{frame_count}", {"mode": mode, "frame_count": frame_count}, {
+            "time": time_call(generate, repeat=repeat),
+        }
+
+
+def bench_startup(quick, repeat):
+    """ registering the nodes must not import the heavy modules or read files like .env """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, PACKAGE_DIR, *HEAVY_MODULES], capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    times = [run["import_s"] for run in runs]
+    result = {
+        "time": {"median_s": statistics.median(times), "min_s": min(times), "max_s": max(times), "repeat": repeat},
+        "nodes_registered": runs[0]["nodes"],
+        "heavy_modules_imported": sorted({module for run in runs for module in run["modules"]}),
+        "files_opened": sorted({path for run in runs for path in run["files"]}),
+    }
+    if result["heavy_modules_imported"] or result["files_opened"]:
+        result["failed"] = f"importing the package imported {result['heavy_modules_imported']} and opened {result['files_opened']}"
+    yield "import package", {"heavy_modules": HEAVY_MODULES}, result
+
+
+SUITES = {
+    "startup": bench_startup,
+    "spherical_to_cubemap": bench_spherical_to_cubemap,
+    "cubemap_to_spherical": bench_cubemap_to_spherical,
+    "round_trip": bench_round_trip,
+    "precision": bench_precision,
+    "panorama_views": bench_panorama_views,
+    "social_media_handle": bench_social_media_handle,
+    "telegram": bench_telegram,
+    "telegram_delivery": bench_telegram_delivery,
+    "animated_seed": bench_animated_seed,
+}
+
+
+def run(suites, quick, repeat):
+    results = []
+    for suite in suites:
+        for case, params, result in SUITES[suite](quick, repeat):
+            results.append({"suite": suite, "case": case, "params": params, **result})
+            print(f"{suite:22} {case:34} {summarize(result)}", file=sys.stderr)
+    return results
+
+
+def failures(results):
+    """ the cases whose checks failed, e.g. a retry that didn't happen or an error over its documented bound """
+    return [entry for entry in results if "failed" in entry]
+
+
+def summarize(result):
+    if "skipped" in result:
+        return f"skipped: {result['skipped']}"
+    parts = [f"{result['time']['median_s'] * 1000:9.2f} ms"]
+    if "heavy_modules_imported" in result:
+        parts.append(f"heavy modules imported: {result['heavy_modules_imported'] or 'none'}, files opened: {len(result['files_opened'])}")
+    if "psnr_db" in result:
+        parts.append(f"{result['psnr_db']:6.2f} dB")
+    if "max_abs_error" in result:
+        parts.append(f"max error {result['max_abs_error']:.2e}")
+    if "memory" in result:
+        parts.append(f"{result['memory']['torch_peak_bytes'] / 2 ** 20:8.1f} MiB peak, {result['memory']['torch_allocations']} allocs")
+    if "failed" in result:
+        parts.append(f"FAILED: {result['failed']}")
+    return "  ".join(parts)
+
+
+def compare(results, baseline):
+    """ prints the change of every case against an earlier run """
+    previous = {(entry["suite"], entry["case"]): entry for entry in baseline["results"]}
+    for entry in results:
+        before = previous.get((entry["suite"], entry["case"]))
+        if before is None or "time" not in entry or "time" not in before:
+            continue
+        line = f"{entry['suite']:22} {entry['case']:34} {entry['time']['median_s'] / before['time']['median_s']:6.2f}x time"
+        if "psnr_db" in entry and "psnr_db" in before:
+            line += f"  {entry['psnr_db'] - before['psnr_db']:+6.2f} dB"
+        if "memory" in entry and "memory" in before and before["memory"]["torch_peak_bytes"]:
+            line += f"  {entry['memory']['torch_peak_bytes'] / before['memory']['torch_peak_bytes']:6.2f}x peak"
+        print(line, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="suite to run, can be repeated, defaults to all")
+    parser.add_argument("--quick", action="store_true", help="small sizes only, for a fast check")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default")
+    parser.add_argument("--profile", action="store_true", help="time the stages inside the nodes and add the totals to the results")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    instrumentation = load_node_module("instrumentation")
+    instrumentation.set_enabled(args.profile)
+
+    ## the nodes print progress, keep stdout for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.suite or list(SUITES), args.quick, args.repeat)
+
+    report = {"environment": environment(), "quick": args.quick, "max_rss_bytes": max_rss_bytes(), "results": results}
+    if args.profile:
+        report["stages"] = instrumentation.METRICS.snapshot()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    failed = failures(results)
+    if failed:
+        print(f"{len(failed)} check(s) failed: {', '.join(entry['suite'] + ' ' + entry['case'] for entry in failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,110 @@
-import re
-import random
+import bisect
+import functools
+import hashlib
+import math
 
-class AnimatedSeed:
-    OUTPUT_SEED = None
+MAX_SEED = 0xffffffffffffffff
+
+
+class Keyframes:
+    """ a set of keyframes kept as arithmetic progressions, so long ranges cost nothing to store or count
+
+    The frames are split into disjoint pieces (lo, hi, period, offsets): the keyframes in [lo, hi] are
+    the frames lo + k * period + offset. Where ranges overlap, the piece repeats every lcm of their steps,
+    so a frame listed by several ranges is counted once. """
+
+    def __init__(self, progressions):
+        self.pieces = []
+        self.totals = [0]
+
+        ## sweep over the points where ranges start and end, the ranges active in between stay the same
+        boundaries = sorted({start for start, _, _ in progressions} | {end + 1 for _, end, _ in progressions})
+        starts = sorted(progressions)
+        active, next_start = [], 0
+        for lo, next_boundary in zip(boundaries, boundaries[1:]):
+            hi = next_boundary - 1
+            while next_start < len(starts) and starts[next_start][0] <= lo:
+                active.append(starts[next_start])
+                next_start += 1
+            active = [progression for progression in active if progression[1] >= lo]
+            if active:
+                self.add_piece(lo, hi, active)
+
+    def add_piece(self, lo, hi, active):
+        ## the first keyframe of every range at or after lo
+        firsts = [(start + -(lo - start) // step * -step, step) for start, _, step in active]
+
+        ## drop the ranges whose keyframes a range with a smaller step already hits, a step 1 range covers all others
+        kept = []
+        for first, step in sorted(firsts, key=lambda item: item[1]):
+            if not any(step % other_step == 0 and (first - other_first) % other_step == 0 for other_first, other_step in kept):
+                kept.append((first, step))
+        firsts = kept
+
+        period = functools.reduce(math.lcm, (step for _, step in firsts))
+        window = min(period, hi - lo + 1)
+        offsets = sorted({offset for first, step in firsts for offset in range(first - lo, window, step)})
+        if not offsets:
+            return
+
+        piece = (lo, hi, window if window < period else period, tuple(offsets))
+        self.pieces.append(piece)
+        self.totals.append(self.totals[-1] + self.piece_count(piece, hi))
+
+    @staticmethod
+    def piece_count(piece, frame):
+        """ keyframes of the piece at or before frame """
+        lo, hi, period, offsets = piece
+        if frame < lo:
+            return 0
+        full, remainder = divmod(min(frame, hi) - lo, period)
+        return full * len(offsets) + bisect.bisect_right(offsets, remainder)
+
+    def count_upto(self, frame):
+        """ number of keyframes at or before frame """
+        index = bisect.bisect_right(self.pieces, (frame, math.inf)) - 1
+        if index < 0:
+            return 0
+        return self.totals[index] + self.piece_count(self.pieces[index], frame)
+
+    def next_after(self, frame):
+        """ the first keyframe after frame, or None """
+        index = max(0, bisect.bisect_right(self.pieces, (frame, math.inf)) - 1)
+        for lo, hi, period, offsets in self.pieces[index:]:
+            full, remainder = divmod(max(0, frame + 1 - lo), period)
+            position = bisect.bisect_left(offsets, remainder)
+            candidate = lo + full * period + (offsets[position] if position < len(offsets) else period + offsets[0])
+            if candidate <= hi:
+                return candidate
+        return None
+
+
+@functools.lru_cache(maxsize=128)
+def parse_keyframes(keyframes):
+    """ parses keyframes like "0, 12, 20-100:10" into Keyframes,
+    ranges are inclusive and step by 1 unless a step is given """
+    progressions = []
+    for token in keyframes.replace('\n', ',').split(','):
+        token = token.strip()
+        if not token:
+            continue
+        try:
+            if '-' in token:
+                span, _, step = token.partition(':')
+                start, end = (int(value) for value in span.split('-'))
+                step = int(step) if step.strip() else 1
+                if step < 1 or end < start:
+                    raise ValueError
+                ## the last frame the range actually reaches
+                progressions.append((start, end - (end - start) % step, step))
+            else:
+                progressions.append((int(token), int(token), 1))
+        except ValueError:
+            raise ValueError(f"Invalid keyframe '{token}', expected a frame number or a range like 0-100:10")
+    return Keyframes(progressions)
 
+
+class AnimatedSeed:
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -11,7 +112,7 @@ class AnimatedSeed:
                 "keyframes": ("STRING", {"multiline": True}),
                 "current_frame": ("INT", {"default": 0, "min": 0, "max": 10000}),
                 "mode": (["randomize", "increment"],),
-                "base_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff}),
+                "base_seed": ("INT", {"default": 0, "min": 0, "max": MAX_SEED}),
             },
         }
 
@@ -20,37 +121,68 @@ class AnimatedSeed:
     CATEGORY = "utils"
 
     @classmethod
-    def get_new_seed(cls, mode, current_seed):
+    def get_segment_seed(cls, mode, base_seed, segment):
+        """ seed of the segment that starts at the `segment`-th keyframe, segment 0 runs up to the first keyframe """
+        if segment == 0:
+            return base_seed
         if mode == "randomize":
-            new_seed = random.randint(0, 0xffffffffffffffff)
+            ## a hash of the base seed and segment, the same on every worker and in any frame order
+            digest = hashlib.blake2b(f"{base_seed}:{segment}".encode(), digest_size=8).digest()
+            return int.from_bytes(digest, "little")
         elif mode == "increment":
-            new_seed = current_seed + 1
-        else:
-            new_seed = current_seed
-        return new_seed
+            return (base_seed + segment) & MAX_SEED
+        return base_seed
 
     def generate_seed(self, keyframes, current_frame, mode, base_seed):
-        frame_numbers = [int(frame.strip()) for frame in keyframes.split(',')]
+        ## the seed changes on every keyframe up to and including the current frame
+        segment = parse_keyframes(keyframes).count_upto(current_frame)
 
-        if AnimatedSeed.OUTPUT_SEED is None:
-            AnimatedSeed.OUTPUT_SEED = base_seed
+        return (self.get_segment_seed(mode, base_seed, segment),)
 
-        if current_frame in frame_numbers:
-            new_seed = self.get_new_seed(mode, AnimatedSeed.OUTPUT_SEED)
-            AnimatedSeed.OUTPUT_SEED = new_seed
-            return (new_seed,)
-
-        return (AnimatedSeed.OUTPUT_SEED, )
 
+class AnimatedSeedBatch:
     @classmethod
-    def IS_CHANGED(cls, keyframes, current_frame, mode, base_seed):
-        return float("nan")
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "keyframes": ("STRING", {"multiline": True}),
+                "start_frame": ("INT", {"default": 0, "min": 0, "max": 100000}),
+                "frame_count": ("INT", {"default": 100, "min": 1, "max": 100000}),
+                "mode": (["randomize", "increment"],),
+                "base_seed": ("INT", {"default": 0, "min": 0, "max": MAX_SEED}),
+            },
+        }
+
+    RETURN_TYPES = ("INT", "STRING")
+    RETURN_NAMES = ("seeds", "seed_schedule")
+    OUTPUT_IS_LIST = (True, False)
+    FUNCTION = "generate_seeds"
+    CATEGORY = "utils"
+
+    def generate_seeds(self, keyframes, start_frame, frame_count, mode, base_seed):
+        frames = parse_keyframes(keyframes)
+
+        ## walk the frames once, only computing a new seed when a keyframe is passed
+        segment = frames.count_upto(start_frame)
+        seed = AnimatedSeed.get_segment_seed(mode, base_seed, segment)
+        next_keyframe = frames.next_after(start_frame)
+        seeds = []
+        for frame in range(start_frame, start_frame + frame_count):
+            if next_keyframe is not None and next_keyframe <= frame:
+                segment = frames.count_upto(frame)
+                seed = AnimatedSeed.get_segment_seed(mode, base_seed, segment)
+                next_keyframe = frames.next_after(frame)
+            seeds.append(seed)
+
+        return (seeds, ",".join(str(seed) for seed in seeds))
 
 
 NODE_CLASS_MAPPINGS = {
-    "AnimatedSeed": AnimatedSeed
+    "AnimatedSeed": AnimatedSeed,
+    "AnimatedSeedBatch": AnimatedSeedBatch,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
-    "AnimatedSeed": "Animated Seed"
+    "AnimatedSeed": "Animated Seed",
+    "AnimatedSeedBatch": "Animated Seed (Batch)",
 }
@@ -0,0 +1,37 @@
+# How the six faces are arranged, the first entry is the default
+CUBEMAP_LAYOUTS = ["separate", "horizontal_cross", "strip_3x2", "strip_6x1"]
+
+# Cell (column, row) of every face. Faces keep the orientation of the separate face outputs,
+# which line up seamlessly in the horizontal cross. "separate" is the faces stacked vertically.
+LAYOUT_CELLS = {
+    "separate": {"front": (0, 0), "back": (0, 1), "left": (0, 2), "right": (0, 3), "top": (0, 4), "bottom": (0, 5)},
+    "horizontal_cross": {"top": (1, 0), "left": (0, 1), "front": (1, 1), "right": (2, 1), "back": (3, 1), "bottom": (1, 2)},
+    "strip_3x2": {"right": (0, 0), "left": (1, 0), "top": (2, 0), "bottom": (0, 1), "front": (1, 1), "back": (2, 1)},
+    "strip_6x1": {"right": (0, 0), "left": (1, 0), "top": (2, 0), "bottom": (3, 0), "front": (4, 0), "back": (5, 0)},
+}
+
+
+def layout_grid(layout):
+    """ (columns, rows) of faces in a layout """
+    cells = LAYOUT_CELLS[layout].values()
+    return max(column for column, _ in cells) + 1, max(row for _, row in cells) + 1
+
+
+def atlas_face_size(atlas, layout):
+    """ (width, height) of the faces in a [B,H,W,C] atlas """
+    columns, rows = layout_grid(layout)
+    height, width = atlas.shape[1], atlas.shape[2]
+    if height % rows or width % columns:
+        raise ValueError(f"A {layout} cubemap must be {columns} x {rows} faces, got an atlas of {width} x {height} pixels")
+    return width // columns, height // rows
+
+
+def face_views(atlas, layout, face_names):
+    """ the faces of an atlas as strided views, in the order of face_names """
+    width, height = atlas_face_size(atlas, layout)
+    views = []
+    for name in face_names:
+        column, row = LAYOUT_CELLS[layout][name]
+        views.append(atlas[:, row * height:(row + 1) * height, column * width:(column + 1) * width])
+    return views
+
@@ -1,149 +1,442 @@
+import functools
+import json
+import os
+import tempfile
+
 import numpy as np
 import torch
 
+from .cubemap_layout import CUBEMAP_LAYOUTS, face_views
+from .instrumentation import stage
+from .projection import CUBE_EDGE_COUNT, FACE_EDGES, FACE_NAMES, CubemapProjection, EquirectProjection, build_map, prefilter_ratio, sample, sample_pixels
+from .projection_cache import PROJECTION_CACHE
+from .sampling import COMPUTE_DTYPES, FILTER_MODES, FILTER_PADDING, prefilter_nhwc, prefilter_size, resolve_compute_dtype
+
+
+# How the projected colours are brought into the 0-1 range, the first entry is the default
+NORMALIZE_MODES = ["clamp", "minmax", "per-channel", "none"]
+
+# Modes that treat every pixel on its own, so part of a frame can be updated without touching the rest
+PIXELWISE_NORMALIZE_MODES = ("clamp", "none")
+
+# Storage of the seam mask, uint8 holds the mask scaled to 0-255 and bool marks the pixels the uint8 mask doesn't round to zero
+MASK_DTYPES = {"float32": torch.float32, "uint8": torch.uint8, "bool": torch.bool}
+
+# numpy dtypes of file backed outputs, numpy has no bfloat16 so those are stored as float32
+MEMMAP_DTYPES = {torch.float32: np.float32, torch.uint8: np.uint8, torch.bool: np.bool_}
+
+# Blur kernels wider than this are applied with FFTs instead of direct convolution
+FFT_BLUR_MIN_KERNEL_SIZE = 31
+
+# Upper bound on the stacked faces held in memory at once when projecting a batch
+BATCH_CHUNK_BYTES = 256 * 1024 * 1024
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(kernel_size, sigma, device):
+    x = torch.arange(-(kernel_size // 2), kernel_size // 2 + 1, dtype=torch.float32, device=device)
+    kernel = torch.exp(-x**2 / (2 * sigma**2))
+    return kernel / kernel.sum()
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel_spectrum(kernel_size, sigma, length, device):
+    # Conjugated, so multiplying by it correlates instead of convolves
+    return torch.fft.rfft(gaussian_kernel(kernel_size, sigma, device), n=length).conj()
+
+
+def same_face(face, previous, version):
+    """ whether face holds the pixels `previous` held when its version counter was `version` """
+    if face.shape != previous.shape or face.dtype != previous.dtype or face.device != previous.device:
+        return False
+    # Modified in place since, the old pixels are gone
+    if previous._version != version:
+        return False
+    # The same tensor, or the same view into an unchanged atlas
+    if face.data_ptr() == previous.data_ptr() and face.stride() == previous.stride():
+        return True
+    return torch.equal(face, previous)
+
+
 class CubemapToSphericalV2:
     @classmethod
     def INPUT_TYPES(s):
         return {
             "required": {
+                "output_width": ("INT", {"default": 1024, "min": 64, "max": 32768}),
+                "output_height": ("INT", {"default": 512, "min": 32, "max": 16384}),
+                "edge_width": ("FLOAT", {"default": 5.0, "min": 0.1, "max": 20.0, "step": 0.1}),
+                "mask_blur": ("FLOAT", {"default": 1.0, "min": 0.1, "max": 100.0, "step": 0.1}),
+            },
+            "optional": {
                 "cubemap_front": ("IMAGE",),
                 "cubemap_back": ("IMAGE",),
                 "cubemap_left": ("IMAGE",),
                 "cubemap_right": ("IMAGE",),
                 "cubemap_top": ("IMAGE",),
                 "cubemap_bottom": ("IMAGE",),
-                "output_width": ("INT", {"default": 1024, "min": 64, "max": 8192}),
-                "output_height": ("INT", {"default": 512, "min": 32, "max": 4096}),
-                "edge_width": ("FLOAT", {"default": 5.0, "min": 0.1, "max": 20.0, "step": 0.1}),
-                "mask_blur": ("FLOAT", {"default": 1.0, "min": 0.1, "max": 100.0, "step": 0.1}),
-            }
+                "layout": (CUBEMAP_LAYOUTS,),
+                "cubemap_atlas": ("IMAGE",),
+                "batch_chunk": ("INT", {"default": 0, "min": 0, "max": 4096}),
+                "filter": (FILTER_MODES,),
+                "antialias": ("BOOLEAN", {"default": False}),
+                "tile_rows": ("INT", {"default": 0, "min": 0, "max": 16384}),
+                "memmap_output": ("BOOLEAN", {"default": False}),
+                "normalize": (NORMALIZE_MODES,),
+                "compute_dtype": (COMPUTE_DTYPES,),
+                "incremental": ("BOOLEAN", {"default": False}),
+                "mask_dtype": (list(MASK_DTYPES),),
+            },
         }
 
-    RETURN_TYPES = ("IMAGE", "MASK")
+    RETURN_TYPES = ("IMAGE", "MASK", "STRING")
+    RETURN_NAMES = ("image", "mask", "seam_boxes")
     FUNCTION = "convert"
     CATEGORY = "image/processing"
 
-    def convert(self, cubemap_front, cubemap_back, cubemap_left, cubemap_right, cubemap_top, cubemap_bottom, output_width, output_height, edge_width, mask_blur):
+    def __init__(self):
+        # The faces and result of the last call, so a call where only some faces changed can update just their pixels
+        self.last_result = None
+
+    def convert(self, cubemap_front=None, cubemap_back=None, cubemap_left=None, cubemap_right=None, cubemap_top=None, cubemap_bottom=None,
+                output_width=1024, output_height=512, edge_width=5.0, mask_blur=1.0, layout="separate", cubemap_atlas=None,
+                batch_chunk=0, filter="nearest", antialias=False, tile_rows=0, memmap_output=False, normalize="clamp", compute_dtype="auto",
+                incremental=False, mask_dtype="float32"):
         # Convert edge_width from percentage to decimal
         edge_width = edge_width / 100.0
 
-        # Combine cubemap faces into a single tensor
-        cubemap = torch.stack([
-            cubemap_back[0], cubemap_bottom[0], cubemap_front[0],
-            cubemap_left[0], cubemap_right[0], cubemap_top[0]
-        ], dim=0)
-
-        # Ensure the cubemap is in the format [faces, channels, height, width]
-        cubemap = cubemap.permute(0, 3, 1, 2)
-
-        # Generate spherical coordinates
-        u = torch.linspace(-1, 1, output_width, device=cubemap.device)
-        v = torch.linspace(-1, 1, output_height, device=cubemap.device)
-        v, u = torch.meshgrid(v, u, indexing='ij')
-
-        # Convert to spherical angles
-        theta = u * np.pi
-        phi = v * np.pi / 2
-
-        # Convert spherical to Cartesian coordinates
-        x = torch.cos(phi) * torch.cos(theta)
-        y = torch.sin(phi)
-        z = torch.cos(phi) * torch.sin(theta)
-
-        # Prepare output tensor and edge mask
-        output = torch.zeros(output_height, output_width, 3, device=cubemap.device)
-        edge_mask = torch.zeros(output_height, output_width, dtype=torch.float32, device=cubemap.device)
-
-        # Find colors for each pixel
-        abs_x, abs_y, abs_z = torch.abs(x), torch.abs(y), torch.abs(z)
-
-        # Face selection logic
-        is_x_face = (abs_x >= abs_y) & (abs_x >= abs_z)
-        is_y_face = (abs_y > abs_x) & (abs_y >= abs_z)
-        is_z_face = (abs_z > abs_x) & (abs_z > abs_y)
-
-        # X faces (left and right)
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_x_face & (x < 0), 3, edge_width, flip_x=True)  # Left
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_x_face & (x >= 0), 4, edge_width)  # Right
-
-        # Y faces (top and bottom)
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_y_face & (y < 0), 5, edge_width, flip_y=True)  # Top
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_y_face & (y >= 0), 1, edge_width)  # Bottom
-
-        # Z faces (front and back)
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_z_face & (z < 0), 2, edge_width)  # Front
-        self.sample_face(output, edge_mask, cubemap, x, y, z, is_z_face & (z >= 0), 0, edge_width, flip_x=True)  # Back
-
-        # Normalize to 0-1 range
-        output = (output - output.min()) / (output.max() - output.min())
-
-        # Apply Gaussian blur to the edge mask
+        # Faces in the order of the face indices used by the projection map
+        if layout == "separate":
+            faces = [cubemap_front, cubemap_back, cubemap_left, cubemap_right, cubemap_top, cubemap_bottom]
+            if any(face is None for face in faces):
+                raise ValueError("The separate layout needs all six cubemap faces connected")
+        else:
+            if cubemap_atlas is None:
+                raise ValueError(f"The {layout} layout needs a cubemap_atlas")
+            # Strided views into the atlas, nothing is copied
+            faces = face_views(cubemap_atlas, layout, FACE_NAMES)
+        batch_size = self.get_batch_size(faces)
+        face_height, face_width = faces[0].shape[1], faces[0].shape[2]
+        channels = min(3, faces[0].shape[3])
+        device, dtype = faces[0].device, resolve_compute_dtype(compute_dtype, faces[0].dtype, filter)
+
+        # Box-filter the faces first when they are denser than the output, like sampling from a mip level
+        target = EquirectProjection(output_width, output_height)
+        sample_size = (face_width, face_height)
+        if antialias:
+            ratio = prefilter_ratio(CubemapProjection(sample_size), target)
+            sample_size = prefilter_size(face_width, face_height, ratio)
+
+        # An atlas is sampled in place, unless the faces have to be prefiltered into a new tensor first
+        source_layout = layout if sample_size == (face_width, face_height) else "separate"
+        atlas = cubemap_atlas if source_layout != "separate" else None
+        source = CubemapProjection(sample_size, source_layout)
+
+        # Tiled mode works on bands of rows, so peak memory follows the tile size instead of the output size
         kernel_size = max(3, int(mask_blur * 4)) | 1  # Ensure odd kernel size
-        blurred_edge_mask = self.custom_gaussian_blur(edge_mask, kernel_size=kernel_size, sigma=mask_blur)
-
-        # Combine sharp and blurred masks
-        combined_mask = torch.maximum(edge_mask, blurred_edge_mask)
-
-        # Add batch dimension and ensure float32 dtype
-        output = output.unsqueeze(0).to(torch.float32)
-        mask_output = combined_mask.unsqueeze(0).unsqueeze(0).to(torch.float32)
-
-        return (output, mask_output)
-
-    def sample_face(self, output, edge_mask, cubemap, x, y, z, mask, face_idx, edge_width, flip_x=False, flip_y=False):
-        w, h = cubemap.shape[2], cubemap.shape[3]
-
-        if face_idx in [3, 4]:  # Left or Right face
-            uu = z / torch.abs(x)
-            vv = y / torch.abs(x)
-        elif face_idx in [1, 5]:  # Bottom or Top face
-            uu = x / torch.abs(y)
-            vv = z / torch.abs(y)
-        else:  # Front or Back face
-            uu = x / torch.abs(z)
-            vv = y / torch.abs(z)
-
-        if flip_x:
-            uu = -uu
-        if flip_y:
-            vv = -vv
-
-        # Scale to image coordinates
-        xx = ((uu + 1) * w / 2)
-        yy = ((vv + 1) * h / 2)
+        tiled = 0 < tile_rows < output_height
+        bands = [(row, min(row + tile_rows, output_height)) for row in range(0, output_height, tile_rows)] if tiled else [(0, output_height)]
+
+        # Project the batch in chunks so the stacked faces stay within a fixed memory budget
+        if batch_chunk <= 0:
+            frame_bytes = 6 * face_height * face_width * channels * torch.finfo(dtype).bits // 8
+            batch_chunk = max(1, BATCH_CHUNK_BYTES // frame_bytes)
+
+        # Only pixelwise results of the whole frame can be patched, the last result is reused for the same geometry
+        incremental = incremental and not tiled and not memmap_output and normalize in PIXELWISE_NORMALIZE_MODES
+        geometry = (output_width, output_height, edge_width, mask_blur, layout, filter, antialias, normalize, mask_dtype, batch_size, channels, device, dtype)
+        changed = self.changed_faces(geometry, faces) if incremental else None
+        if changed == []:
+            return self.last_result["output"], self.last_result["mask"], self.last_result["seam_boxes"]
+
+        with stage("cubemap_to_spherical.allocate") as timing:
+            if changed is not None:
+                # The pixels of unchanged faces are copied, the mask only depends on the geometry and is kept as is
+                output, mask_output, seam_boxes = self.last_result["output"].clone(), self.last_result["mask"], self.last_result["seam_boxes"]
+                timing.allocated(output)
+            else:
+                # Write straight into preallocated outputs, optionally backed by a file on disk
+                # A file backed output is float32 from the start, each band is converted as it is written
+                output_dtype = torch.float32 if memmap_output else dtype
+                output = self.allocate_output((batch_size, output_height, output_width, channels), output_dtype, device, memmap_output)
+                mask_output = self.allocate_output((batch_size, output_height, output_width), MASK_DTYPES[mask_dtype], device, memmap_output)
+                timing.allocated(output, mask_output)
+
+                # Top and bottom row of every cube edge's band in each output column, gathered while the bands are projected
+                seam_top = torch.full((CUBE_EDGE_COUNT, output_width), output_height, dtype=torch.long, device=device)
+                seam_bottom = torch.full((CUBE_EDGE_COUNT, output_width), -1, dtype=torch.long, device=device)
+
+        for start in range(0, batch_size, batch_chunk):
+            end = min(start + batch_chunk, batch_size)
+            with stage("cubemap_to_spherical.prepare_source") as timing:
+                # Nearest sampling of the changed pixels never reads the other faces, filtered sampling reads their borders
+                copied = changed if changed is not None and filter == "nearest" else range(len(faces))
+                prepared = self.prepare_source(faces, start, end, channels, source, filter, dtype, atlas=atlas, copied=copied)
+                timing.allocated(prepared)
+
+            if changed is not None:
+                with stage("cubemap_to_spherical.projection_map"):
+                    projection = self.cached_projection_map(source, target, edge_width, filter, device, dtype)
+                    pixels = self.changed_pixels(projection, changed, (source.key, target.key, edge_width, filter, device, dtype))
+
+                # Resample only the output pixels that read from the changed faces
+                with stage("cubemap_to_spherical.sampling") as timing:
+                    sampled = sample_pixels(prepared, projection, filter, pixels)
+                    timing.allocated(sampled)
+                    self.normalize_frames(sampled, normalize)
+                    output[start:end].view(end - start, -1, channels).index_copy_(1, pixels, sampled.to(output.dtype))
+                continue
+
+            for row_start, row_end in bands:
+                # The mask blur needs a halo of rows around each band
+                halo = kernel_size // 2 if tiled else 0
+                low, high = max(0, row_start - halo), min(output_height, row_end + halo)
+
+                with stage("cubemap_to_spherical.projection_map"):
+                    if tiled:
+                        projection = self.build_projection_map(source, target, edge_width, filter, device, dtype, rows=(low, high))
+                    else:
+                        projection = self.cached_projection_map(source, target, edge_width, filter, device, dtype)
+
+                inner = slice(row_start - low, row_end - low)
+                with stage("cubemap_to_spherical.sampling"):
+                    sample(prepared, projection, filter, output[start:end, row_start:row_end], rows=inner)
+
+                # The seams are the same for every frame, so the mask is only built once
+                if start == 0:
+                    with stage("cubemap_to_spherical.seam_mask"):
+                        torch.minimum(seam_top, projection["seam_top"], out=seam_top)
+                        torch.maximum(seam_bottom, projection["seam_bottom"], out=seam_bottom)
+
+                        if tiled:
+                            row_padding = (halo - (row_start - low), halo - (high - row_end))
+                            seam_mask = self.build_seam_mask(projection["edge_mask"], kernel_size, mask_blur, row_padding=row_padding, rows=inner)
+                        else:
+                            # The mask only depends on the geometry, so it is cached alongside the projection map
+                            key = ("cubemap_seam_mask", output_width, output_height, sample_size, edge_width, mask_blur, device)
+                            seam_mask = PROJECTION_CACHE.get_or_build(
+                                key, lambda: {"mask": self.build_seam_mask(projection["edge_mask"], kernel_size, mask_blur)}
+                            )["mask"]
+                        mask_output[:, row_start:row_end] = self.convert_mask(seam_mask, mask_dtype)
+
+            # Bring each frame into the 0-1 range, in place
+            with stage("cubemap_to_spherical.normalize"):
+                self.normalize_frames(output[start:end], normalize)
+
+        if changed is None:
+            seam_boxes = json.dumps(self.seam_boxes(seam_top, seam_bottom, kernel_size // 2, output_height))
+
+        # Ensure float32 dtype
+        output = output.to(torch.float32)
+
+        # Keep references to the faces, not copies, with their version counters to notice in-place changes
+        self.last_result = {
+            "geometry": geometry,
+            "faces": [(face, face._version) for face in faces],
+            "output": output,
+            "mask": mask_output,
+            "seam_boxes": seam_boxes,
+            "versions": (output._version, mask_output._version),
+        } if incremental else None
+
+        return (output, mask_output, seam_boxes)
+
+    def changed_faces(self, geometry, faces):
+        """ indices of the faces that differ from the last call, None when the last result can't be reused """
+        last = self.last_result
+        if last is None or last["geometry"] != geometry:
+            return None
+        # A downstream node modified the returned tensors in place
+        if (last["output"]._version, last["mask"]._version) != last["versions"]:
+            return None
+
+        changed = [i for i, (face, (previous, version)) in enumerate(zip(faces, last["faces"])) if not same_face(face, previous, version)]
+        return changed if len(changed) < len(faces) else None
+
+    def changed_pixels(self, projection, changed, key):
+        """ flat indices of the output pixels that read from any of the changed faces """
+        def build():
+            faces = torch.tensor(changed, dtype=projection["face"].dtype, device=projection["face"].device)
+            affected = torch.isin(projection["face"], faces)
+            # Filtered pixels near a face border also read the padding taken from the neighbouring faces
+            if "border" in projection:
+                affected |= projection["border"]
+            return {"pixels": affected.view(-1).nonzero().squeeze(1)}
+
+        return PROJECTION_CACHE.get_or_build(("cubemap_changed_pixels",) + key + (tuple(changed),), build)["pixels"]
+
+    def get_batch_size(self, faces):
+        # Faces with a single frame are broadcast against the rest of the batch
+        batch_size = max(face.shape[0] for face in faces)
+        for face in faces:
+            if face.shape[0] not in (1, batch_size):
+                raise ValueError(f"Cubemap faces have mismatched batch sizes: {[face.shape[0] for face in faces]}")
+            if face.shape[1:3] != faces[0].shape[1:3]:
+                raise ValueError(f"Cubemap faces must all be the same size: {[tuple(face.shape[1:3]) for face in faces]}")
+        return batch_size
+
+    def normalize_frames(self, frames, mode):
+        if mode == "none":
+            return
+        if mode == "clamp":
+            # Keeps the colours as they are, only filtered overshoot is cut off
+            frames.clamp_(0, 1)
+            return
+
+        # Stretch each frame (or each channel of each frame) to span 0-1
+        dims = (1, 2, 3) if mode == "minmax" else (1, 2)
+        low = frames.amin(dim=dims, keepdim=True)
+        value_range = frames.amax(dim=dims, keepdim=True).sub_(low)
+
+        # Flat frames have nothing to stretch and are left untouched
+        flat = value_range <= 0
+        low.masked_fill_(flat, 0)
+        value_range.masked_fill_(flat, 1)
+        frames.sub_(low).div_(value_range)
+
+    def allocate_output(self, shape, dtype, device, memmap_output):
+        if not memmap_output or device.type != "cpu":
+            return torch.empty(shape, dtype=dtype, device=device)
+
+        # An anonymous temporary file, the mapping keeps the storage alive until the tensor is freed.
+        # It is unlinked right away on POSIX and deleted once the mapping closes on Windows, which
+        # refuses to remove a file that is still mapped
+        with tempfile.TemporaryFile(suffix=".raw", dir=os.getenv("COZY_MEMMAP_DIR")) as file:
+            array = np.memmap(file, dtype=MEMMAP_DTYPES.get(dtype, np.float32), mode="w+", shape=shape)
+        return torch.from_numpy(array)
+
+    def prepare_source(self, faces, start, end, channels, source, filter, dtype, atlas=None, copied=range(6)):
+        count = end - start
+
+        if atlas is not None:
+            # The atlas pixels are the source, only converted when the compute dtype differs
+            return source.prepare(atlas[start:end, ..., :channels].to(dtype), filter)
+
+        # Combine cubemap faces into a single tensor [batch, faces, height, width, channels],
+        # converting to the compute dtype on the way in. Faces that are not copied are left uninitialised
+        cubemap = torch.empty((count, 6) + tuple(faces[0].shape[1:3]) + (channels,), dtype=dtype, device=faces[0].device)
+        for i in copied:
+            face = faces[i]
+            cubemap[:, i] = face[start:end, ..., :channels] if face.shape[0] > 1 else face[:, ..., :channels]
+
+        face_width, face_height = source.face_size
+        if (face_width, face_height) != (cubemap.shape[3], cubemap.shape[2]):
+            cubemap = prefilter_nhwc(cubemap.flatten(0, 1), source.face_size)
+
+        # The faces stacked vertically are the "separate" layout
+        return source.prepare(cubemap.reshape(count, 6 * face_height, face_width, channels), filter)
+
+    def cached_projection_map(self, source, target, edge_width, filter, device, dtype):
+        # Fetch the per-pixel face index, source index and edge mask for this geometry
+        key = ("cubemap_to_spherical", source.key, target.key, edge_width, filter, device, dtype)
+        return PROJECTION_CACHE.get_or_build(key, lambda: self.build_projection_map(source, target, edge_width, filter, device, dtype))
+
+    def build_projection_map(self, source, target, edge_width, filter, device, dtype, rows=None):
+        # Where every output pixel (or a band of rows) lands on the cube
+        projection, location = build_map(source, target, filter, device, dtype, rows=rows)
 
         # Detect edges
+        w, h = source.face_size
+        xx, yy = location["x"], location["y"]
         is_edge = (xx < edge_width * w) | (xx > w - edge_width * w) | (yy < edge_width * h) | (yy > h - edge_width * h)
-        edge_mask[mask] = torch.maximum(edge_mask[mask], is_edge[mask].float())
 
-        # Clamp coordinates for sampling
-        xx = xx.long().clamp(0, w - 1)
-        yy = yy.long().clamp(0, h - 1)
+        projection["face"] = location["face"]
+        projection["edge_mask"] = is_edge.to(dtype)
+
+        # Which cube edge every edge pixel belongs to, the one along the nearest side of its face,
+        # reduced to the rows its band covers in every output column
+        rows_index, columns = is_edge.nonzero(as_tuple=True)
+        x, y = xx[rows_index, columns] / w, yy[rows_index, columns] / h
+        side = torch.stack([x, 1 - x, y, 1 - y]).argmin(dim=0)
+        edge = torch.tensor(FACE_EDGES, device=device)[location["face"][rows_index, columns].long(), side]
+        slots = edge * is_edge.shape[1] + columns
+        rows_index = rows_index + (rows[0] if rows is not None else 0)
+
+        shape = (CUBE_EDGE_COUNT, is_edge.shape[1])
+        projection["seam_top"] = torch.full(shape, target.size[1], dtype=torch.long, device=device)
+        projection["seam_top"].view(-1).scatter_reduce_(0, slots, rows_index, "amin")
+        projection["seam_bottom"] = torch.full(shape, -1, dtype=torch.long, device=device)
+        projection["seam_bottom"].view(-1).scatter_reduce_(0, slots, rows_index, "amax")
+
+        # Pixels whose filter footprint reaches past the face border
+        if filter != "nearest":
+            margin = FILTER_PADDING + 1
+            projection["border"] = (xx < margin) | (xx > w - margin) | (yy < margin) | (yy > h - margin)
+        return projection
+
+    def seam_boxes(self, seam_top, seam_bottom, radius, height):
+        """ bounding boxes of the seam mask, one per cube edge, split where an edge crosses the panorama seam """
+        width = seam_top.shape[1]
+        boxes = []
+        for top, bottom in zip(seam_top.cpu(), seam_bottom.cpu()):
+            columns = (bottom >= 0).nonzero().squeeze(1)
+            if len(columns) == 0:
+                continue
+            # Runs of neighbouring columns, an edge crossing the left and right border of the panorama is two runs
+            breaks = (columns.diff() > 1).nonzero().squeeze(1) + 1
+            for run in torch.tensor_split(columns, breaks):
+                left, right = int(run[0]), int(run[-1]) + 1
+                # Grown by the blur radius, which is how far the blurred mask reaches past the edge pixels
+                x, y = max(0, left - radius), max(0, int(top[left:right].min()) - radius)
+                boxes.append({
+                    "x": x, "y": y,
+                    "width": min(width, right + radius) - x,
+                    "height": min(height, int(bottom[left:right].max()) + 1 + radius) - y,
+                })
+        return boxes
+
+    def convert_mask(self, mask, mask_dtype):
+        if mask_dtype == "uint8":
+            return mask.mul(255).round_().to(torch.uint8)
+        if mask_dtype == "bool":
+            # The pixels that are not zero in the uint8 mask, the FFT blur leaves tiny values everywhere
+            return mask >= 0.5 / 255
+        return mask
+
+    def build_seam_mask(self, edge_mask, kernel_size, sigma, row_padding=None, rows=slice(None)):
+        # Apply Gaussian blur to the edge mask
+        edge_mask = edge_mask.to(torch.float32)
+        blurred_edge_mask = self.custom_gaussian_blur(edge_mask, kernel_size=kernel_size, sigma=sigma, row_padding=row_padding)
 
-        # Sample colors
-        sampled_colors = cubemap[face_idx, :, yy[mask], xx[mask]]
-        output[mask] = sampled_colors.permute(1, 0)
+        # Combine sharp and blurred masks
+        return torch.maximum(edge_mask[rows], blurred_edge_mask)
 
-    def custom_gaussian_blur(self, img, kernel_size, sigma):
+    def custom_gaussian_blur(self, img, kernel_size, sigma, row_padding=None):
         # Generate Gaussian kernel
-        x = torch.arange(-(kernel_size // 2), kernel_size // 2 + 1, dtype=torch.float32, device=img.device)
-        kernel = torch.exp(-x**2 / (2 * sigma**2))
-        kernel = kernel / kernel.sum()
+        kernel = gaussian_kernel(kernel_size, sigma, img.device)
+
+        # Pad the image, a band of rows that already carries its neighbouring rows only needs the remainder
+        pad_size = kernel_size // 2
+        pad_top, pad_bottom = row_padding if row_padding is not None else (pad_size, pad_size)
+        padded_img = torch.nn.functional.pad(img.unsqueeze(0).unsqueeze(0), (pad_size, pad_size, pad_top, pad_bottom), mode='reflect')
+
+        # Large kernels are applied in the frequency domain, where the cost does not grow with the kernel size
+        if kernel_size > FFT_BLUR_MIN_KERNEL_SIZE:
+            blurred = self.fft_correlate(padded_img, kernel_size, sigma, dim=2)
+            blurred = self.fft_correlate(blurred, kernel_size, sigma, dim=3)
+            return blurred.squeeze(0).squeeze(0)
 
         # Reshape kernel for 2D convolution
         kernel_x = kernel.view(1, 1, kernel_size, 1)
         kernel_y = kernel.view(1, 1, 1, kernel_size)
 
-        # Pad the image
-        pad_size = kernel_size // 2
-        padded_img = torch.nn.functional.pad(img.unsqueeze(0).unsqueeze(0), (pad_size, pad_size, pad_size, pad_size), mode='reflect')
-
         # Apply separable Gaussian blur
         blurred = torch.nn.functional.conv2d(padded_img, kernel_x, padding=0)
         blurred = torch.nn.functional.conv2d(blurred, kernel_y, padding=0)
 
         return blurred.squeeze(0).squeeze(0)
 
+    def fft_correlate(self, img, kernel_size, sigma, dim):
+        # Same result as a 'valid' conv2d along one dimension: the padded length leaves room for the
+        # whole kernel, so the circular correlation never wraps into the kept outputs
+        length = img.shape[dim]
+        kernel_spectrum = gaussian_kernel_spectrum(kernel_size, sigma, length, img.device)
+        shape = [1] * img.dim()
+        shape[dim] = kernel_spectrum.shape[0]
+        spectrum = torch.fft.rfft(img, n=length, dim=dim) * kernel_spectrum.view(shape)
+        blurred = torch.fft.irfft(spectrum, n=length, dim=dim)
+        return blurred.narrow(dim, 0, length - kernel_size + 1)
+
 NODE_CLASS_MAPPINGS = {
     "CubemapToSphericalV2": CubemapToSphericalV2
 }
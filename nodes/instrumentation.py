@@ -0,0 +1,97 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger("cozy_toolbelt")
+
+# Set COZY_PROFILE=1 to time the stages of every node, off by default
+ENABLED = os.getenv("COZY_PROFILE", "0").lower() not in ("", "0", "false", "no")
+
+
+class Stage:
+    """ what one run of a stage took, nodes report the buffers they allocate with `allocated` """
+    __slots__ = ("name", "seconds", "allocations", "bytes")
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.allocations = 0
+        self.bytes = 0
+
+    def allocated(self, *buffers):
+        """ counts torch tensors and numpy arrays created by the stage """
+        for buffer in buffers:
+            self.allocations += 1
+            self.bytes += buffer.nbytes if hasattr(buffer, "nbytes") else buffer.numel() * buffer.element_size()
+
+    def add_bytes(self, nbytes):
+        """ counts bytes that aren't a buffer, e.g. an encoded file or an upload """
+        self.bytes += nbytes
+
+
+class DisabledStage:
+    """ stands in for Stage while profiling is off, so nodes don't need to check """
+    __slots__ = ()
+
+    def allocated(self, *buffers):
+        pass
+
+    def add_bytes(self, nbytes):
+        pass
+
+
+DISABLED_STAGE = DisabledStage()
+
+
+class MetricsRegistry:
+    """ running totals of every stage in the process, for reading from code instead of the log """
+
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage):
+        with self._lock:
+            totals = self._totals.setdefault(stage.name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "allocations": 0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += stage.seconds
+            totals["max_seconds"] = max(totals["max_seconds"], stage.seconds)
+            totals["allocations"] += stage.allocations
+            totals["bytes"] += stage.bytes
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(totals) for name, totals in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+
+METRICS = MetricsRegistry()
+
+
+def set_enabled(enabled):
+    """ turns profiling on or off at runtime, overriding COZY_PROFILE """
+    global ENABLED
+    ENABLED = bool(enabled)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ times the block as stage `name`, logs it and adds it to METRICS when profiling is enabled """
+    if not ENABLED:
+        yield DISABLED_STAGE
+        return
+
+    current = Stage(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - start
+        METRICS.record(current)
+        logger.info("%s: %.2f ms, %d allocations, %.1f MB", name, current.seconds * 1000, current.allocations, current.bytes / 1024 / 1024)
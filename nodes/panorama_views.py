@@ -0,0 +1,81 @@
+from .instrumentation import stage
+from .projection import EquirectProjection, FisheyeProjection, PerspectiveProjection, antialias_source, reproject
+from .sampling import COMPUTE_DTYPES, FILTER_MODES, resolve_compute_dtype
+
+
+def camera_inputs(fov_default, fov_max):
+    """ the inputs shared by both view nodes """
+    return {
+        "required": {
+            "spherical_image": ("IMAGE",),
+            "width": ("INT", {"default": 1024, "min": 64, "max": 8192}),
+            "height": ("INT", {"default": 1024, "min": 64, "max": 8192}),
+            "fov": ("FLOAT", {"default": fov_default, "min": 1.0, "max": fov_max, "step": 0.5}),
+            "yaw": ("FLOAT", {"default": 0.0, "min": -360.0, "max": 360.0, "step": 0.5}),
+            "pitch": ("FLOAT", {"default": 0.0, "min": -90.0, "max": 90.0, "step": 0.5}),
+            "roll": ("FLOAT", {"default": 0.0, "min": -180.0, "max": 180.0, "step": 0.5}),
+        },
+        "optional": {
+            "filter": (FILTER_MODES,),
+            "antialias": ("BOOLEAN", {"default": False}),
+            "compute_dtype": (COMPUTE_DTYPES,),
+        },
+    }
+
+
+def extract_view(name, spherical_image, target, filter, antialias, compute_dtype):
+    spherical_image = spherical_image.to(resolve_compute_dtype(compute_dtype, spherical_image.dtype, filter))
+    source = EquirectProjection(spherical_image.shape[2], spherical_image.shape[1])
+
+    if antialias:
+        with stage(f"{name}.prefilter") as timing:
+            spherical_image, source = antialias_source(spherical_image, source, target)
+            timing.allocated(spherical_image)
+
+    with stage(f"{name}.sampling") as timing:
+        view = reproject(spherical_image, source, target, filter)
+        timing.allocated(view)
+    return (view,)
+
+
+class PanoramaToPerspective:
+    @classmethod
+    def INPUT_TYPES(s):
+        return camera_inputs(90.0, 179.0)
+
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("view",)
+    FUNCTION = "convert"
+    CATEGORY = "image/processing"
+
+    def convert(self, spherical_image, width, height, fov, yaw, pitch, roll, filter="nearest", antialias=False, compute_dtype="auto"):
+        ## fov is the horizontal field of view, yaw turns right, pitch looks up
+        target = PerspectiveProjection(width, height, fov, yaw, pitch, roll)
+        return extract_view("panorama_to_perspective", spherical_image, target, filter, antialias, compute_dtype)
+
+
+class PanoramaToFisheye:
+    @classmethod
+    def INPUT_TYPES(s):
+        return camera_inputs(180.0, 360.0)
+
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("fisheye",)
+    FUNCTION = "convert"
+    CATEGORY = "image/processing"
+
+    def convert(self, spherical_image, width, height, fov, yaw, pitch, roll, filter="nearest", antialias=False, compute_dtype="auto"):
+        ## equidistant fisheye, the image circle spans the shorter side and everything outside it is black
+        target = FisheyeProjection(width, height, fov, yaw, pitch, roll)
+        return extract_view("panorama_to_fisheye", spherical_image, target, filter, antialias, compute_dtype)
+
+
+NODE_CLASS_MAPPINGS = {
+    "PanoramaToPerspective": PanoramaToPerspective,
+    "PanoramaToFisheye": PanoramaToFisheye,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "PanoramaToPerspective": "Panorama to Perspective View",
+    "PanoramaToFisheye": "Panorama to Fisheye",
+}
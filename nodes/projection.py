@@ -0,0 +1,483 @@
+import math
+
+import torch
+
+from .cubemap_layout import LAYOUT_CELLS, face_views, layout_grid
+from .projection_cache import PROJECTION_CACHE
+from .sampling import FILTER_PADDING, grid_sample_nhwc, prefilter_nhwc, prefilter_size, to_grid_coords
+
+
+# Every projection maps pixels to directions in one shared frame: +z is up, the front face looks
+# along -y with +x to its right, and the panorama seam runs through -x
+
+
+# The cube faces, in the order of the face indices
+FACE_NAMES = ["front", "back", "left", "right", "top", "bottom"]
+
+# Per face, the directions of the face's right (a) and down (b) axes and its centre: a point at
+# face coordinates (a, b) in [-1, 1] looks along a * right + b * down + centre
+FACE_AXES = {
+    "front": ((1, 0, 0), (0, 0, -1), (0, -1, 0)),
+    "back": ((-1, 0, 0), (0, 0, -1), (0, 1, 0)),
+    "left": ((0, -1, 0), (0, 0, -1), (-1, 0, 0)),
+    "right": ((0, 1, 0), (0, 0, -1), (1, 0, 0)),
+    "top": ((1, 0, 0), (0, -1, 0), (0, 0, 1)),
+    "bottom": ((1, 0, 0), (0, 1, 0), (0, 0, -1)),
+}
+
+
+def cube_edges():
+    """ per face, the id (0-11) of the cube edge along its left, right, top and bottom side """
+    midpoints = {}
+    edges = []
+    for name in FACE_NAMES:
+        right, down, centre = FACE_AXES[name]
+        sides = []
+        for axis, sign in ((right, -1), (right, 1), (down, -1), (down, 1)):
+            # Two face sides are the same cube edge when their midpoints coincide
+            midpoint = tuple(c + sign * v for c, v in zip(centre, axis))
+            sides.append(midpoints.setdefault(midpoint, len(midpoints)))
+        edges.append(sides)
+    return edges
+
+
+# The cube edge along the left, right, top and bottom side of every face, in the order of FACE_NAMES
+FACE_EDGES = cube_edges()
+CUBE_EDGE_COUNT = 12
+
+
+def pixel_centres(count, device, start=0, end=None):
+    """ centres of pixels start to end of a row of `count` pixels, in the [-1, 1] range """
+    end = count if end is None else end
+    return (torch.arange(start, end, device=device, dtype=torch.float32) + 0.5) * (2 / count) - 1
+
+
+def camera_basis(yaw, pitch, roll):
+    """ forward, right and up directions of a camera turned by yaw, pitch and roll degrees from the front face """
+    yaw, pitch, roll = math.radians(yaw), math.radians(pitch), math.radians(roll)
+
+    # Yaw turns to the right around the vertical axis, pitch tilts up
+    forward = (math.sin(yaw) * math.cos(pitch), -math.cos(yaw) * math.cos(pitch), math.sin(pitch))
+    right = (math.cos(yaw), math.sin(yaw), 0.0)
+    up = (
+        forward[1] * right[2] - forward[2] * right[1],
+        forward[2] * right[0] - forward[0] * right[2],
+        forward[0] * right[1] - forward[1] * right[0],
+    )
+
+    # Roll turns the image clockwise around the view axis
+    right, up = (
+        tuple(math.cos(roll) * r - math.sin(roll) * u for r, u in zip(right, up)),
+        tuple(math.sin(roll) * r + math.cos(roll) * u for r, u in zip(right, up)),
+    )
+    return forward, right, up
+
+
+def dot(x, y, z, axis):
+    return x * axis[0] + y * axis[1] + z * axis[2]
+
+
+class Projection:
+    """ a way of laying out the sphere on an image, used as the source or the target of a reprojection """
+
+    # Pixels added around the source before filtered sampling, 0 lets grid_sample clamp at the border
+    filter_padding = 0
+
+    def directions(self, device, rows=None):
+        """ (x, y, z, valid) for every target pixel, valid is None when every pixel sees the sphere """
+        raise NotImplementedError
+
+    def locate(self, x, y, z):
+        """ where the directions land in the source, at least {"x", "y"} in pixel edge coordinates """
+        raise NotImplementedError
+
+    def pixel_angles(self):
+        """ (smallest, largest) angle covered by one pixel, for choosing the antialias prefilter """
+        raise NotImplementedError
+
+    def pixel_index(self, location):
+        width, height = self.size
+        xx = location["x"].long().clamp_(0, width - 1)
+        yy = location["y"].long().clamp_(0, height - 1)
+        return yy.mul_(width).add_(xx)
+
+    def grid(self, location):
+        width, height, pad = self.size[0], self.size[1], self.filter_padding
+        return torch.stack([
+            to_grid_coords(location["x"] + pad, width + 2 * pad),
+            to_grid_coords(location["y"] + pad, height + 2 * pad),
+        ], dim=-1)
+
+    def resized(self, size):
+        """ the same projection at another image size """
+        raise NotImplementedError(f"{type(self).__name__} can't be resized")
+
+    def prefilter(self, images, ratio):
+        """ box-filters [B,H,W,C] images down by `ratio`, returns the images and their projection """
+        width, height = self.size
+        size = prefilter_size(width, height, ratio)
+        if size == (width, height):
+            return images, self
+        return prefilter_nhwc(images, size), self.resized(size)
+
+    def pad(self, images):
+        return images
+
+    def prepare(self, images, filter):
+        """ the [B,H,W,C] source images in the form the sampling map reads """
+        if filter == "nearest":
+            return images.reshape(images.shape[0], -1, images.shape[3])
+        return self.pad(images)
+
+
+class EquirectProjection(Projection):
+    filter_padding = FILTER_PADDING
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.key = ("equirect", width, height)
+
+    def directions(self, device, rows=None):
+        width, height = self.size
+        start, end = rows if rows is not None else (0, height)
+
+        # Longitude runs from the seam at -pi, colatitude from the top pole down
+        theta = pixel_centres(width, device) * math.pi
+        phi = (pixel_centres(height, device, start, end) + 1) * (math.pi / 2)
+        phi, theta = torch.meshgrid(phi, theta, indexing="ij")
+
+        sin_phi = torch.sin(phi)
+        return sin_phi * torch.cos(theta), sin_phi * torch.sin(theta), torch.cos(phi), None
+
+    def locate(self, x, y, z):
+        width, height = self.size
+        r = torch.sqrt(x * x + y * y + z * z)
+        theta = torch.atan2(y, x)
+        phi = torch.acos((z / r).clamp_(-1, 1))
+        return {"x": theta.add_(math.pi).mul_(width / (2 * math.pi)), "y": phi.mul_(height / math.pi)}
+
+    def pixel_angles(self):
+        width, height = self.size
+        angles = (2 * math.pi / width, math.pi / height)
+        return min(angles), max(angles)
+
+    def resized(self, size):
+        return EquirectProjection(*size)
+
+    def pad(self, images):
+        # Rows past a pole continue on the opposite meridian, half a turn around
+        pad, width = self.filter_padding, images.shape[2]
+        top = torch.roll(images[:, :pad].flip(1), width // 2, dims=2)
+        bottom = torch.roll(images[:, -pad:].flip(1), width // 2, dims=2)
+        padded = torch.cat([top, images, bottom], dim=1)
+
+        # Columns past the left and right edges wrap around
+        return torch.cat([padded[:, :, -pad:], padded, padded[:, :, :pad]], dim=2)
+
+
+class CubemapProjection(Projection):
+    """ the six faces of a cube, stored in the cells of an atlas layout """
+    filter_padding = FILTER_PADDING
+
+    def __init__(self, face_size, layout="separate"):
+        self.face_size = face_size
+        self.layout = layout
+        columns, rows = layout_grid(layout)
+        self.size = (columns * face_size[0], rows * face_size[1])
+        self.key = ("cubemap", face_size, layout)
+
+    def directions(self, device, rows=None):
+        face_width, face_height = self.face_size
+        width, height = self.size
+        # Empty cells look straight up, so every pixel has a well defined direction
+        x, y, z = torch.zeros((height, width), device=device), torch.zeros((height, width), device=device), torch.ones((height, width), device=device)
+        valid = torch.zeros((height, width), dtype=torch.bool, device=device)
+
+        b, a = torch.meshgrid(pixel_centres(face_height, device), pixel_centres(face_width, device), indexing="ij")
+        for name in FACE_NAMES:
+            column, row = LAYOUT_CELLS[self.layout][name]
+            cell = (slice(row * face_height, (row + 1) * face_height), slice(column * face_width, (column + 1) * face_width))
+            for component, (right, down, centre) in zip((x, y, z), zip(*FACE_AXES[name])):
+                component[cell] = a * right + b * down + centre
+            valid[cell] = True
+
+        if rows is not None:
+            x, y, z, valid = (values[rows[0]:rows[1]] for values in (x, y, z, valid))
+
+        # Only layouts with empty cells have pixels outside the cube
+        columns, cell_rows = layout_grid(self.layout)
+        return x, y, z, valid if columns * cell_rows > len(FACE_NAMES) else None
+
+    def locate(self, x, y, z):
+        face, a, b = self.select_faces(x, y, z)
+        face_width, face_height = self.face_size
+        return {"face": face, "x": a.add_(1).mul_(face_width / 2), "y": b.add_(1).mul_(face_height / 2)}
+
+    def select_faces(self, x, y, z):
+        """ (face index, a, b) of the face each direction passes through """
+        abs_x, abs_y, abs_z = torch.abs(x), torch.abs(y), torch.abs(z)
+
+        # Face selection logic, every direction lands on exactly one face
+        is_x_face = (abs_x >= abs_y) & (abs_x >= abs_z)
+        is_y_face = (abs_y >= abs_z) & ~is_x_face
+
+        face_index = torch.where(
+            is_x_face, torch.where(x < 0, 2, 3),
+            torch.where(is_y_face, torch.where(y < 0, 0, 1), torch.where(z > 0, 4, 5)),
+        ).to(torch.uint8)
+
+        # Project onto the selected face, dividing by the direction's component along the face centre
+        a = torch.where(is_x_face, y / x, torch.where(is_y_face, -x / y, x / abs_z))
+        b = torch.where(is_x_face, -z / abs_x, torch.where(is_y_face, -z / abs_y, -y / z))
+        return face_index, a.clamp_(-1, 1), b.clamp_(-1, 1)
+
+    def pixel_angles(self):
+        # A face pixel spans 2 / face_width radians at the face centre
+        angle = 2 / self.face_size[0]
+        return angle, angle
+
+    def resized(self, size):
+        columns, rows = layout_grid(self.layout)
+        return CubemapProjection((size[0] // columns, size[1] // rows), self.layout)
+
+    def prefilter(self, images, ratio):
+        # Every face is filtered on its own, so the filter never mixes pixels of neighbouring atlas cells
+        face_size = prefilter_size(self.face_size[0], self.face_size[1], ratio)
+        if face_size == self.face_size:
+            return images, self
+
+        columns, rows = layout_grid(self.layout)
+        resized = self.resized((face_size[0] * columns, face_size[1] * rows))
+        batch_size, channels = images.shape[0], images.shape[3]
+        faces = prefilter_nhwc(torch.stack(face_views(images, self.layout, FACE_NAMES), dim=1).flatten(0, 1), face_size)
+
+        # Empty cells stay black
+        atlas = images.new_zeros((batch_size, resized.size[1], resized.size[0], channels))
+        for view, face in zip(face_views(atlas, self.layout, FACE_NAMES), faces.unflatten(0, (batch_size, 6)).unbind(1)):
+            view.copy_(face)
+        return atlas, resized
+
+    def pixel_index(self, location):
+        face_width, face_height = self.face_size
+        xx = location["x"].long().clamp_(0, face_width - 1)
+        yy = location["y"].long().clamp_(0, face_height - 1)
+        return self.atlas_index(location["face"], yy, xx)
+
+    def atlas_index(self, face, yy, xx):
+        """ flat index into the atlas pixels of integer face pixel coordinates """
+        face_width, face_height = self.face_size
+        columns, _ = layout_grid(self.layout)
+        cells = torch.tensor([LAYOUT_CELLS[self.layout][name] for name in FACE_NAMES], device=face.device)
+        cell = cells[face.long()]
+        return (cell[..., 1] * face_height + yy).mul_(columns * face_width).add_(cell[..., 0] * face_width + xx)
+
+    def grid(self, location):
+        # Continuous position inside the padded faces, stacked vertically
+        face_width, face_height, pad = self.face_size[0], self.face_size[1], self.filter_padding
+        atlas_width, atlas_height = face_width + 2 * pad, 6 * (face_height + 2 * pad)
+        atlas_y = location["face"].to(location["y"].dtype).mul_(face_height + 2 * pad).add_(location["y"] + pad)
+        return torch.stack([to_grid_coords(location["x"] + pad, atlas_width), to_grid_coords(atlas_y, atlas_height)], dim=-1)
+
+    def pad(self, images):
+        # Lay the faces out as one tall atlas, each face padded with the pixels of its neighbours,
+        # so the filter footprint crosses face borders seamlessly
+        face_width, face_height, pad = self.face_size[0], self.face_size[1], self.filter_padding
+        key = ("cubemap_padding", self.face_size, pad, self.layout, images.device)
+        pad_index = PROJECTION_CACHE.get_or_build(key, lambda: {"index": self.build_padding_map(images.device)})["index"]
+        padded = images.reshape(images.shape[0], -1, images.shape[3]).index_select(1, pad_index)
+        return padded.view(images.shape[0], 6 * (face_height + 2 * pad), face_width + 2 * pad, images.shape[3])
+
+    def build_padding_map(self, device):
+        # Pixel centres of every face, extended by `pad` pixels past each border
+        face_width, face_height, pad = self.face_size[0], self.face_size[1], self.filter_padding
+        a = (torch.arange(-pad, face_width + pad, device=device, dtype=torch.float32) + 0.5) * (2 / face_width) - 1
+        b = (torch.arange(-pad, face_height + pad, device=device, dtype=torch.float32) + 0.5) * (2 / face_height) - 1
+        b, a = torch.meshgrid(b, a, indexing="ij")
+
+        # Directions past a border land on the neighbouring face, which supplies the padding
+        directions = [torch.stack([a * right + b * down + centre for right, down, centre in zip(*FACE_AXES[name])]) for name in FACE_NAMES]
+        x, y, z = torch.stack(directions, dim=1)
+        return self.pixel_index(self.locate(x, y, z)).view(-1)
+
+
+class PerspectiveProjection(Projection):
+    """ a rectilinear camera view, fov is the horizontal field of view in degrees """
+
+    def __init__(self, width, height, fov, yaw=0.0, pitch=0.0, roll=0.0):
+        self.size = (width, height)
+        self.fov = fov
+        self.angles = (yaw, pitch, roll)
+        self.basis = camera_basis(yaw, pitch, roll)
+        self.key = ("perspective", width, height, fov, yaw, pitch, roll)
+
+    def image_plane(self):
+        # Half extent of the image plane at distance one, square pixels
+        width, height = self.size
+        half_width = math.tan(math.radians(self.fov) / 2)
+        return half_width, half_width * height / width
+
+    def directions(self, device, rows=None):
+        width, height = self.size
+        start, end = rows if rows is not None else (0, height)
+        half_width, half_height = self.image_plane()
+        b, a = torch.meshgrid(pixel_centres(height, device, start, end) * half_height, pixel_centres(width, device) * half_width, indexing="ij")
+
+        forward, right, up = self.basis
+        x, y, z = (f + a * r - b * u for f, r, u in zip(forward, right, up))
+        return x, y, z, None
+
+    def locate(self, x, y, z):
+        width, height = self.size
+        forward, right, up = self.basis
+        half_width, half_height = self.image_plane()
+
+        depth = dot(x, y, z, forward)
+        a = dot(x, y, z, right).div_(depth * half_width)
+        b = dot(x, y, z, up).div_(depth * -half_height)
+
+        # Only directions in front of the camera and inside the frame have a source pixel
+        valid = (depth > 0) & (a.abs() <= 1) & (b.abs() <= 1)
+        return {"x": a.add_(1).mul_(width / 2), "y": b.add_(1).mul_(height / 2), "valid": valid}
+
+    def pixel_angles(self):
+        # At the image centre
+        angle = 2 * self.image_plane()[0] / self.size[0]
+        return angle, angle
+
+    def resized(self, size):
+        return PerspectiveProjection(*size, self.fov, *self.angles)
+
+
+class FisheyeProjection(Projection):
+    """ an equidistant fisheye, the image circle spans the shorter side and covers fov degrees """
+
+    def __init__(self, width, height, fov, yaw=0.0, pitch=0.0, roll=0.0):
+        self.size = (width, height)
+        self.fov = fov
+        self.angles = (yaw, pitch, roll)
+        self.basis = camera_basis(yaw, pitch, roll)
+        self.key = ("fisheye", width, height, fov, yaw, pitch, roll)
+
+    def directions(self, device, rows=None):
+        width, height = self.size
+        start, end = rows if rows is not None else (0, height)
+        diameter = min(width, height)
+        ny, nx = torch.meshgrid(pixel_centres(height, device, start, end) * (height / diameter), pixel_centres(width, device) * (width / diameter), indexing="ij")
+
+        # The angle from the view axis grows linearly with the distance from the centre
+        radius = torch.sqrt(nx * nx + ny * ny)
+        angle = radius * (math.radians(self.fov) / 2)
+        scale = torch.where(radius > 0, torch.sin(angle) / radius, torch.full_like(radius, math.radians(self.fov) / 2))
+        along = torch.cos(angle)
+
+        forward, right, up = self.basis
+        x, y, z = (along * f + scale * (nx * r - ny * u) for f, r, u in zip(forward, right, up))
+        return x, y, z, radius <= 1
+
+    def locate(self, x, y, z):
+        width, height = self.size
+        forward, right, up = self.basis
+        diameter = min(width, height)
+
+        across, down = dot(x, y, z, right), -dot(x, y, z, up)
+        sideways = torch.sqrt(across * across + down * down)
+        radius = torch.atan2(sideways, dot(x, y, z, forward)).div_(math.radians(self.fov) / 2)
+        scale = torch.where(sideways > 0, radius / sideways, torch.zeros_like(radius))
+
+        nx, ny = across.mul_(scale), down.mul_(scale)
+        return {
+            "x": nx.mul_(diameter / 2).add_(width / 2),
+            "y": ny.mul_(diameter / 2).add_(height / 2),
+            "valid": radius <= 1,
+        }
+
+    def pixel_angles(self):
+        angle = math.radians(self.fov) / min(self.size)
+        return angle, angle
+
+    def resized(self, size):
+        return FisheyeProjection(*size, self.fov, *self.angles)
+
+
+def prefilter_ratio(source, target):
+    """ source pixels per target pixel, above 1 the source is denser than the target and aliases """
+    return target.pixel_angles()[1] / source.pixel_angles()[0]
+
+
+def antialias_source(images, source, target):
+    """ box-filters [B,H,W,C] source images down when they are denser than the target, like sampling
+    from a mip level, returns the images and their projection """
+    return source.prefilter(images, prefilter_ratio(source, target))
+
+
+def build_map(source, target, filter, device, dtype, rows=None):
+    """ sampling map from every target pixel (or a band of rows) to the source, and the located source positions """
+    x, y, z, valid = target.directions(device, rows)
+    location = source.locate(x, y, z)
+    del x, y, z
+
+    if "valid" in location:
+        valid = location["valid"] if valid is None else valid & location["valid"]
+
+    if filter == "nearest":
+        # Flat index into the source pixels
+        projection = {"index": source.pixel_index(location)}
+    else:
+        # Continuous position inside the padded source
+        projection = {"grid": source.grid(location).unsqueeze(0).to(dtype)}
+    if valid is not None:
+        projection["valid"] = valid
+    return projection, location
+
+
+def cached_map(source, target, filter, device, dtype):
+    """ the sampling map of a source and target pair, shared by every node through the projection cache """
+    key = ("projection", source.key, target.key, filter, device, dtype)
+    return PROJECTION_CACHE.get_or_build(key, lambda: build_map(source, target, filter, device, dtype)[0])
+
+
+def sample(source, projection, filter, output, rows=slice(None)):
+    """ samples the prepared source into output [B,h,W,C], using `rows` of the map """
+    count, channels = output.shape[0], output.shape[3]
+
+    if filter == "nearest":
+        # Sample every output pixel of every frame with a single gather
+        index = projection["index"][rows].reshape(-1)
+        if output.is_contiguous() and output.dtype == source.dtype:
+            torch.index_select(source, 1, index, out=output.view(count, -1, channels))
+        else:
+            output.copy_(source.index_select(1, index).view(output.shape))
+    else:
+        grid = projection["grid"][:, rows]
+        output.copy_(grid_sample_nhwc(source, grid.expand(count, -1, -1, -1), filter))
+
+    # Pixels that see nothing of the source are black
+    if "valid" in projection:
+        output.masked_fill_(~projection["valid"][rows].unsqueeze(-1), 0)
+    return output
+
+
+def sample_pixels(source, projection, filter, pixels):
+    """ samples the prepared source at the flat target pixel indices `pixels` only, returns [B,N,C] """
+    count, channels = source.shape[0], source.shape[-1]
+
+    if filter == "nearest":
+        sampled = source.index_select(1, projection["index"].reshape(-1)[pixels])
+    else:
+        grid = projection["grid"].reshape(1, 1, -1, 2)[:, :, pixels]
+        sampled = grid_sample_nhwc(source, grid.expand(count, -1, -1, -1), filter).reshape(count, -1, channels)
+
+    if "valid" in projection:
+        sampled.masked_fill_(~projection["valid"].reshape(-1)[pixels].unsqueeze(-1), 0)
+    return sampled
+
+
+def reproject(images, source, target, filter="nearest", dtype=None):
+    """ reprojects [B,H,W,C] images from the source to the target projection, returns float32 [B,H,W,C] """
+    dtype = dtype or images.dtype
+    batch_size, channels, device = images.shape[0], images.shape[3], images.device
+    projection = cached_map(source, target, filter, device, dtype)
+
+    width, height = target.size
+    output = torch.empty((batch_size, height, width, channels), dtype=torch.float32, device=device)
+    return sample(source.prepare(images.to(dtype), filter), projection, filter, output)
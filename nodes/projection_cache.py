@@ -0,0 +1,69 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+DEFAULT_CACHE_MB = int(os.getenv("COZY_PROJECTION_CACHE_MB", "512"))
+
+
+class ProjectionMapCache:
+    """ LRU cache of precomputed sampling maps, bounded by the total size of the stored tensors """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build_fn):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        ## build outside the lock, maps can take a while at large resolutions
+        entry = build_fn()
+        size = self.entry_nbytes(entry)
+
+        ## entries bigger than the whole budget are used once and not stored
+        if size > self.max_bytes:
+            return entry
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._sizes[key] = size
+                self._total_bytes += size
+            self._entries.move_to_end(key)
+            self.evict()
+            return self._entries.get(key, entry)
+
+    def evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, _ = self._entries.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def entry_nbytes(entry):
+        return sum(value.numel() * value.element_size() for value in entry.values() if isinstance(value, torch.Tensor))
+
+
+# Projection maps shared by every node instance, keyed by geometry, device and dtype
+PROJECTION_CACHE = ProjectionMapCache()
@@ -0,0 +1,51 @@
+import torch
+import torch.nn.functional as F
+
+
+FILTER_MODES = ["nearest", "bilinear", "bicubic"]
+
+# Precision the sampling runs in, "auto" keeps the dtype of the input images
+COMPUTE_DTYPES = ["auto", "fp32", "fp16", "bf16"]
+TORCH_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+# Pixels of neighbouring content added around a source so the bicubic footprint never leaves it
+FILTER_PADDING = 2
+
+
+def resolve_compute_dtype(name, input_dtype, filter):
+    """ torch dtype used for sampling with the given compute_dtype option and filter """
+    dtype = input_dtype if name == "auto" else TORCH_DTYPES[name]
+
+    # grid_sample wants the grid in the image dtype, and half precision coordinates are off by
+    # whole pixels on large sources, so the filtered modes always run in float32
+    if filter != "nearest" and dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return dtype
+
+
+def grid_sample_nhwc(images, grid, mode):
+    """ samples [B,H,W,C] images at the normalized [B,Ho,Wo,2] grid and returns [B,Ho,Wo,C] """
+    # The permute is only a view, grid_sample reads the channels-last strides directly
+    sampled = F.grid_sample(images.permute(0, 3, 1, 2), grid, mode=mode, padding_mode="border", align_corners=False)
+    return sampled.permute(0, 2, 3, 1)
+
+
+def prefilter_nhwc(images, size):
+    """ box-filters [B,H,W,C] images down to size=(width, height) before sampling """
+    width, height = size
+    if (images.shape[2], images.shape[1]) == (width, height):
+        return images
+    filtered = F.interpolate(images.permute(0, 3, 1, 2), size=(height, width), mode="area")
+    return filtered.permute(0, 2, 3, 1)
+
+
+def prefilter_size(width, height, ratio):
+    """ size of a source that has `ratio` source pixels for every output pixel, after prefiltering """
+    if ratio <= 1.0:
+        return width, height
+    return max(1, round(width / ratio)), max(1, round(height / ratio))
+
+
+def to_grid_coords(coords, size):
+    """ converts pixel edge coordinates (0 to size) into grid_sample's [-1, 1] range """
+    return coords * (2.0 / size) - 1.0
@@ -1,9 +1,130 @@
+import functools
+import io
 import os
-import requests
-from PIL import Image, ImageDraw, ImageFont
+import threading
+import time
+from collections import OrderedDict
 import torch
 import numpy as np
 
+from .instrumentation import stage
+
+
+PACKAGE_DIR = os.path.join(os.path.dirname(__file__), "..")
+FONT_PATH = os.path.join(PACKAGE_DIR, "fonts", "DejaVuSans-Bold.ttf")
+
+## logos are read from here first, downloaded logos are stored here so later runs stay offline
+ASSET_DIR = os.getenv("COZY_ASSET_DIR", os.path.join(PACKAGE_DIR, "assets"))
+
+## simple stand-ins shipped with the package, only used while a logo is neither on disk nor downloadable
+PLACEHOLDER_LOGO_DIR = os.path.join(PACKAGE_DIR, "assets", "placeholder_logos")
+LOGO_DOWNLOAD_TIMEOUT = 10
+
+## after a failed download the network is left alone for a while, so offline batches don't retry on every image
+LOGO_RETRY_SECONDS = 300
+LOGO_FAILURES = {}
+
+LOGO_URLS = {
+    "x.com": "https://about.x.com/content/dam/about-twitter/x/large-x-logo.png",
+    "github": "https://github.githubassets.com/favicons/favicon.png",
+    "instagram": "https://upload.wikimedia.org/wikipedia/commons/thumb/2/28/Instagram_logo.png/600px-Instagram_logo.png",
+    }
+
+
+def logo_path(platform):
+    return os.path.join(ASSET_DIR, "logos", f"{platform}.png")
+
+
+def placeholder_logo_path(platform):
+    return os.path.join(PLACEHOLDER_LOGO_DIR, f"{platform}.png")
+
+
+@functools.lru_cache(maxsize=None)
+def load_logo(platform):
+    """ returns the decoded RGBA logo of a platform, downloading it into the asset directory only if it is missing """
+    from PIL import Image
+
+    path = logo_path(platform)
+    if not os.path.exists(path):
+        failed_at = LOGO_FAILURES.get(platform)
+        if failed_at is not None and time.monotonic() - failed_at < LOGO_RETRY_SECONDS:
+            raise FileNotFoundError(f"{path} is missing and the last download failed")
+
+        import requests
+
+        url = LOGO_URLS[platform]
+        try:
+            response = requests.get(url, timeout=LOGO_DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            data = response.content
+        except Exception:
+            LOGO_FAILURES[platform] = time.monotonic()
+            raise
+
+        ## write to a temporary name first so a half written file is never picked up
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            ## read only installs keep the downloaded logo in memory, it is decoded once and cached like a file
+            print(f"-- could not store the {platform} logo in {os.path.dirname(path)}: {e}")
+            with Image.open(io.BytesIO(data)) as logo:
+                return logo.convert("RGBA")
+
+    with Image.open(path) as logo:
+        return logo.convert("RGBA")
+
+
+@functools.lru_cache(maxsize=None)
+def load_placeholder_logo(platform):
+    from PIL import Image
+
+    with Image.open(placeholder_logo_path(platform)) as logo:
+        return logo.convert("RGBA")
+
+
+@functools.lru_cache(maxsize=256)
+def load_resized_logo(platform, height, placeholder=False):
+    from PIL import Image
+
+    logo = load_placeholder_logo(platform) if placeholder else load_logo(platform)
+
+    ## keep the aspect ratio of the logo
+    aspect_ratio = logo.width / logo.height
+    width = max(1, int(height * aspect_ratio))
+    return logo.resize((width, height), Image.LANCZOS)
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_size):
+    from PIL import ImageFont
+
+    if not os.path.exists(FONT_PATH):
+        return ImageFont.load_default(font_size)
+    return ImageFont.truetype(FONT_PATH, font_size)
+
+
+def warm_asset_cache(font_sizes=(24,)):
+    """ loads the fonts and logos up front, fetching any logo missing from the asset directory """
+    for font_size in font_sizes:
+        load_font(font_size)
+    for platform in LOGO_URLS:
+        try:
+            load_logo(platform)
+        except Exception as e:
+            print(f"-- could not load the {platform} logo: {e}")
+
+
+## rendered burn ins, keyed by (username, platform, font_size, size_mult, add_logo)
+OVERLAY_CACHE = OrderedDict()
+OVERLAY_CACHE_SIZE = 64
+
+
+if os.getenv("COZY_WARM_ASSETS"):
+    threading.Thread(target=warm_asset_cache, daemon=True).start()
 
 
 class BurnSocialMediaHandle:
@@ -24,30 +145,47 @@ class BurnSocialMediaHandle:
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "burn_handle"
     CATEGORY = "image/postprocessing"
-    LOGO_URLS = {
-        "x.com": "https://about.x.com/content/dam/about-twitter/x/large-x-logo.png",
-        "github": "https://github.githubassets.com/favicons/favicon.png",
-        "instagram": "https://upload.wikimedia.org/wikipedia/commons/thumb/2/28/Instagram_logo.png/600px-Instagram_logo.png",
-        }
+    LOGO_URLS = LOGO_URLS
 
     def burn_handle(self, image, username, platform, position, font_size, size_mult, add_logo):
-        print(f"-- image.shape start: {image.shape}")
-        img_pil = self.tensor_to_pil(image)
+        ## the burn in is rendered once and reused for every frame and every later call
+        overlay = self.get_overlay(username, platform, font_size, size_mult, add_logo)
+
         ## ----------------------------------------------------------------
 
-        img_pil = self.burn_handle_on_image(img_pil, username, platform, position, font_size, size_mult, add_logo)
+        with stage("social_media_handle.composite") as timing:
+            img_tensor = self.composite_overlay(image, overlay, position)
+            timing.allocated(img_tensor)
 
         ## ----------------------------------------------------------------
-        img_tensor = self.pil_to_tensor(img_pil)
-        print(f"-- image.shape end: {img_tensor.shape}")
 
         return (img_tensor,)
 
-    def burn_handle_on_image(self, img_pil, username, platform, position, font_size, size_mult, add_logo):
-        logo = self.download_logo(platform, add_logo)
+    def get_overlay(self, username, platform, font_size, size_mult, add_logo):
+        key = (username, platform, font_size, size_mult, add_logo)
+        overlay = OVERLAY_CACHE.get(key)
+        if overlay is not None:
+            OVERLAY_CACHE.move_to_end(key)
+            return overlay
 
-        ## initialize the draw object
-        draw_obj = ImageDraw.Draw(img_pil)
+        ## drawing with PIL and converting to tensors, only on a cache miss
+        with stage("social_media_handle.render_overlay") as timing:
+            overlay = self.render_overlay(username, platform, font_size, size_mult, add_logo)
+            timing.allocated(overlay["color"], overlay["alpha"])
+
+        ## an overlay missing its logo is not kept, so the logo shows up once it becomes available
+        if overlay["complete"]:
+            OVERLAY_CACHE[key] = overlay
+            while len(OVERLAY_CACHE) > OVERLAY_CACHE_SIZE:
+                OVERLAY_CACHE.popitem(last=False)
+        return overlay
+
+    def render_overlay(self, username, platform, font_size, size_mult, add_logo):
+        """ renders the logo and handle into a premultiplied RGBA overlay, positioned relative to the burnin position """
+        from PIL import Image, ImageDraw
+
+        ## a scratch draw object, only used to measure the text
+        draw_obj = ImageDraw.Draw(Image.new("L", (1, 1)))
 
         ## prepare the font
         font_obj = self.get_font(font_size)
@@ -55,35 +193,82 @@ class BurnSocialMediaHandle:
         ## get the height and width of the final text
         text_height, text_width = self.prepare_text(draw_obj, username, font_obj)
 
-        ## resize the logo to match the text height
-        logo = self.resize_logo_to_match_text(logo, text_height, size_mult=size_mult)
+        ## grab the logo, already resized to match the text height
+        logo, placeholder = self.resize_logo_to_match_text(platform, add_logo, text_height, size_mult=size_mult)
 
         ## calculate the width of the burnin
         burnin_width = (logo.width + 5 + text_width) if logo else text_width
 
-        ## now grab the position of the logo
-        burnin_pos = self.calculate_logo_position(img_pil, position, text_height, burnin_width)
+        ## the text sits right of the logo, its glyphs can reach outside of the measured box
+        text_pos = (logo.width + 5, 0) if logo else (0, 0)
+        text_bbox = draw_obj.textbbox(text_pos, username, font=font_obj)
+        logo_bbox = (0, int(logo.height / 4), logo.width, int(logo.height / 4) + logo.height) if logo else text_bbox
+        left, top = min(0, text_bbox[0], logo_bbox[0]), min(0, text_bbox[1], logo_bbox[1])
+        right, bottom = max(1, text_bbox[2], logo_bbox[2]), max(1, text_bbox[3], logo_bbox[3])
+        size = (right - left, bottom - top)
 
         ## paste in the logo in front of the burn in text
-        text_pos = self.paste_logo(img_pil, logo, burnin_pos, text_height)
+        color = Image.new("RGB", size, (0, 0, 0))
+        alpha = Image.new("L", size, 0)
+        self.paste_logo(color, alpha, logo, (-left, -top))
+
+        ## draw the text coverage, the text is white
+        text_alpha = Image.new("L", size, 0)
+        ImageDraw.Draw(text_alpha).text((text_pos[0] - left, text_pos[1] - top), username, font=font_obj, fill=255)
 
-        ## draw the text
-        draw_obj.text(text_pos, username, font=font_obj, fill=(255, 255, 255))
+        ## premultiply and layer the text over the logo
+        color = torch.from_numpy(np.array(color)).float() / 255.0
+        alpha = torch.from_numpy(np.array(alpha)).float().unsqueeze(-1) / 255.0
+        text_alpha = torch.from_numpy(np.array(text_alpha)).float().unsqueeze(-1) / 255.0
+        color = text_alpha + color * alpha * (1 - text_alpha)
+        alpha = text_alpha + alpha * (1 - text_alpha)
+
+        return {
+            "color": color,
+            "alpha": alpha,
+            "offset": (left, top),
+            "text_height": text_height,
+            "burnin_width": burnin_width,
+            "complete": (logo is not None and not placeholder) or not add_logo,
+        }
 
-        return img_pil
-        
-    
-    def paste_logo(self, img_pil, logo, burnin_pos, text_height):
-        if not logo: ## if there is no logo, we just return the straight burnin position
-            return burnin_pos
+    def composite_overlay(self, image, overlay, position):
+        batch_size, img_height, img_width = image.shape[0], image.shape[1], image.shape[2]
+
+        ## now grab the position of the burnin and of the overlay's corner
+        burnin_pos = self.calculate_logo_position((img_width, img_height), position, overlay["text_height"], overlay["burnin_width"])
+        x = burnin_pos[0] + overlay["offset"][0]
+        y = burnin_pos[1] + overlay["offset"][1]
+
+        ## clip the overlay to the image
+        height, width = overlay["alpha"].shape[0], overlay["alpha"].shape[1]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(img_width, x + width), min(img_height, y + height)
+
+        img_tensor = image.to(torch.float32, copy=True)
+        if x0 >= x1 or y0 >= y1:
+            return img_tensor
+
+        color = overlay["color"][y0 - y:y1 - y, x0 - x:x1 - x].to(img_tensor.device)
+        alpha = overlay["alpha"][y0 - y:y1 - y, x0 - x:x1 - x].to(img_tensor.device)
+
+        ## premultiplied "over", applied to every frame of the batch at once
+        region = img_tensor[:, y0:y1, x0:x1, :3]
+        region.mul_(1 - alpha).add_(color)
+        region.clamp_(0, 1)
+
+        return img_tensor
+
+    def paste_logo(self, color, alpha, logo, burnin_pos):
+        if not logo: ## if there is no logo, there is nothing to paste
+            return
 
         # logo_y_offset = int((text_height - logo.height) / 2)  # Center logo vertically with text
         logo_y_offset = int(logo.height / 4)
         logo_pos = (burnin_pos[0], burnin_pos[1] + logo_y_offset)
-        img_pil.paste(logo, logo_pos, logo if logo.mode == 'RGBA' else None)
-        text_pos = (burnin_pos[0] + logo.width + 5, burnin_pos[1])
-        return text_pos
-    
+        color.paste(logo.convert("RGB"), logo_pos)
+        alpha.paste(logo.getchannel("A"), logo_pos)
+
     def prepare_text(self, draw_obj, username, font):
         ## now we can get the bbox, width and height of the text
         text_bbox = draw_obj.textbbox((0, 0), username, font=font)
@@ -91,15 +276,13 @@ class BurnSocialMediaHandle:
         text_height = text_bbox[3] - text_bbox[1]
 
         return text_height, text_width
-    
+
     def get_font(self, font_size):
-        font_path = os.path.join(os.path.dirname(__file__), "..", "fonts", "DejaVuSans-Bold.ttf")
-        font = ImageFont.truetype(font_path, font_size)
-        return font
+        return load_font(font_size)
 
-    def calculate_logo_position(self, image, position_name, text_height, total_width):
-        """ receives a PIL image and returns the position of the logo """
-        img_width, img_height = image.size
+    def calculate_logo_position(self, image_size, position_name, text_height, total_width):
+        """ receives the (width, height) of the image and returns the position of the logo """
+        img_width, img_height = image_size
         offset = 30
         position_map = {
             "top_left": (offset, offset),
@@ -111,56 +294,24 @@ class BurnSocialMediaHandle:
 
         return pos
 
-    def resize_logo_to_match_text(self, logo, text_height, size_mult=1.0):
-        if not logo:
-            return 
-
-        ## get the aspect ratio of the logo
-        aspect_ratio = logo.width / logo.height
-        new_logo_height = int(text_height * size_mult)  # Make logo slightly smaller than text
-        new_logo_width = int(new_logo_height * aspect_ratio)
-        logo = logo.resize((new_logo_width, new_logo_height), Image.LANCZOS)
-
-        return logo
-    
-    def download_logo(self, platform, add_logo):
-        logo = None
-        if not add_logo:
-            return logo
-
-        url = self.LOGO_URLS.get(platform)
-        if url:
-            response = requests.get(url, stream=True).raw 
-            logo = Image.open(response)
-        return logo
-
-    def tensor_to_pil(self, image):
-        # Convert tensor image to numpy array
-        img_np = image.squeeze().cpu().numpy()
-        
-        # Ensure the image is in the correct format (HWC)
-        if img_np.shape[2] != 3:
-            img_np = np.transpose(img_np, (1, 2, 0))
-        
-        # Convert to PIL Image
-        img_pil = Image.fromarray((img_np * 255).astype(np.uint8))
-
-        return img_pil
-
-    def pil_to_tensor(self, image):
-        # Convert back to tensor
-        img_np = np.array(image)
-        img_tensor = torch.from_numpy(img_np).float() / 255.0
-        img_tensor = img_tensor.unsqueeze(0)  # Add batch dimension
-        
-        # Ensure the image is in float32 format
-        img_tensor = img_tensor.to(torch.float32)
-        
-        # Clamp values to the range [0, 1]
-        img_tensor = torch.clamp(img_tensor, 0, 1)
+    def resize_logo_to_match_text(self, platform, add_logo, text_height, size_mult=1.0):
+        """ returns the logo and whether it is the placeholder """
+        if not add_logo or platform not in self.LOGO_URLS:
+            return None, False
+
+        new_logo_height = max(1, int(text_height * size_mult))  # Make logo slightly smaller than text
+        try:
+            return load_resized_logo(platform, new_logo_height), False
+        except Exception as e:
+            print(f"-- could not load the {platform} logo: {e}")
+
+        ## without a logo on disk and without network the bundled placeholder stands in, or no logo at all
+        try:
+            return load_resized_logo(platform, new_logo_height, placeholder=True), True
+        except Exception as e:
+            print(f"-- could not load the {platform} placeholder logo, burning the handle without it: {e}")
+            return None, False
 
-        return img_tensor
-    
 NODE_CLASS_MAPPINGS = {
     "BurnSocialMediaHandle": BurnSocialMediaHandle
 }
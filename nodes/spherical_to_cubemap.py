@@ -1,6 +1,10 @@
-import numpy as np
 import torch
 
+from .cubemap_layout import CUBEMAP_LAYOUTS, face_views
+from .instrumentation import stage
+from .projection import FACE_NAMES, CubemapProjection, EquirectProjection, antialias_source, cached_map, sample
+from .sampling import COMPUTE_DTYPES, FILTER_MODES, resolve_compute_dtype
+
 class SphericalToCubemapV2:
     @classmethod
     def INPUT_TYPES(s):
@@ -8,60 +12,56 @@ class SphericalToCubemapV2:
             "required": {
                 "spherical_image": ("IMAGE",),
                 "output_size": ("INT", {"default": 1024, "min": 64, "max": 8192}),
-            }
+            },
+            "optional": {
+                "filter": (FILTER_MODES,),
+                "antialias": ("BOOLEAN", {"default": False}),
+                "compute_dtype": (COMPUTE_DTYPES,),
+                "layout": (CUBEMAP_LAYOUTS,),
+            },
         }
 
-    RETURN_TYPES = ("IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE")
-    RETURN_NAMES = ("front", "back", "left", "right", "top", "bottom")
+    RETURN_TYPES = ("IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE", "IMAGE")
+    RETURN_NAMES = ("front", "back", "left", "right", "top", "bottom", "stacked", "atlas")
     FUNCTION = "convert"
     CATEGORY = "image/processing"
 
-    def convert(self, spherical_image, output_size):
-        # Ensure the spherical image is in the format [batch, channels, height, width]
-        spherical = spherical_image.permute(0, 3, 1, 2)
-
-        # Generate cubemap coordinates
-        x, y = torch.meshgrid(torch.linspace(-1, 1, output_size, device=spherical.device),
-                              torch.linspace(-1, 1, output_size, device=spherical.device),
-                              indexing='ij')
+    def convert(self, spherical_image, output_size, filter="nearest", antialias=False, compute_dtype="auto", layout="separate"):
+        spherical_image = spherical_image.to(resolve_compute_dtype(compute_dtype, spherical_image.dtype, filter))
+        source = EquirectProjection(spherical_image.shape[2], spherical_image.shape[1])
+        target = CubemapProjection((output_size, output_size), layout)
 
-        # Create cubemap faces
-        cubemap_faces = []
-        for i, (x_face, y_face, z_face) in enumerate([
-            (-y, -torch.ones_like(x), -x),  # Front
-            (-y, torch.ones_like(x), x),    # Back
-            (-torch.ones_like(x), -y, -x),  # Left
-            (torch.ones_like(x), y, -x),  # Right
-            (y, -x, torch.ones_like(x)),  # Top
-            (y, x, -torch.ones_like(x)),  # Bottom 
-        ]):
-            # Convert to spherical coordinates
-            r = torch.sqrt(x_face**2 + y_face**2 + z_face**2)
-            theta = torch.atan2(y_face, x_face)
-            phi = torch.acos(z_face / r)
+        # Box-filter the panorama first when it is denser than the faces, like sampling from a mip level
+        if antialias:
+            with stage("spherical_to_cubemap.prefilter") as timing:
+                spherical_image, source = antialias_source(spherical_image, source, target)
+                timing.allocated(spherical_image)
 
-            # Map to spherical image coordinates
-            u = (theta + np.pi) / (2 * np.pi)
-            v = phi / np.pi
+        batch_size, channels = spherical_image.shape[0], spherical_image.shape[3]
+        device, dtype = spherical_image.device, spherical_image.dtype
 
-            # Sample from spherical image
-            u = (u * spherical.shape[3]).long().clamp(0, spherical.shape[3] - 1)
-            v = (v * spherical.shape[2]).long().clamp(0, spherical.shape[2] - 1)
+        # Fetch the sampling map of every atlas pixel for this geometry
+        with stage("spherical_to_cubemap.projection_map"):
+            projection = cached_map(source, target, filter, device, dtype)
 
-            face = spherical[:, :, v, u]
-            cubemap_faces.append(face)
+        with stage("spherical_to_cubemap.sampling") as timing:
+            # The faces are written straight into the atlas of the chosen layout, "separate" stacks them vertically,
+            # cells of the atlas without a face are left black
+            atlas = torch.empty((batch_size, target.size[1], target.size[0], channels), dtype=torch.float32, device=device)
+            timing.allocated(atlas)
+            sample(source.prepare(spherical_image, filter), projection, filter, atlas)
 
-        # Convert to the desired output format [batch, height, width, channels]
-        cubemap_faces = [face.permute(0, 2, 3, 1) for face in cubemap_faces]
+        # The individual outputs are views into the atlas
+        cubemap_faces = tuple(face_views(atlas, layout, FACE_NAMES))
 
-        # Flip the Front face horizontally
-        cubemap_faces[0] = torch.flip(cubemap_faces[0], dims=[2])
-        
-        # Rotate the Back face 180 degrees counter-clockwise and flip horizontally
-        cubemap_faces[1] = torch.rot90(cubemap_faces[1], k=2, dims=[1, 2])
-        cubemap_faces[1] = torch.flip(cubemap_faces[1], dims=[2])
+        # Frames stay together in the stacked output, [batch * 6, height, width, channels],
+        # only a view when the faces are stacked already
+        if layout == "separate":
+            stacked = atlas.view(batch_size * 6, output_size, output_size, channels)
+        else:
+            stacked = torch.stack(cubemap_faces, dim=1).view(batch_size * 6, output_size, output_size, channels)
 
-        return tuple(cubemap_faces)
+        return cubemap_faces + (stacked, atlas)
 
 NODE_CLASS_MAPPINGS = {
     "SphericalToCubemapV2": SphericalToCubemapV2
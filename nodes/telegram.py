@@ -1,18 +1,48 @@
+import functools
+import json
 import os
+import shutil
 import subprocess
 import tempfile
-import requests
-from PIL import Image
+import threading
 import torch
 import numpy as np
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+from .instrumentation import stage
 
-# Get Telegram bot token and chat ID from environment variables
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
+# Frames converted to uint8 per write to ffmpeg
+FRAMES_PER_WRITE = 8
+
+# x264 presets, the first entry is the default
+X264_PRESETS = ["medium", "ultrafast", "superfast", "veryfast", "faster", "fast", "slow", "slower", "veryslow"]
+
+# What to send when the video is over the upload limit, the first entry is the default
+OVERSIZE_FALLBACKS = ["reencode", "animation", "photos", "document", "none"]
+
+MAX_ALBUM_PHOTOS = 10
+SIZE_TARGET_RETRIES = 2
+
+# (max fps, max dimension) of the GIF fallback, each step is tried until the GIF fits the upload limit
+GIF_STEPS = [(15, 480), (10, 360), (8, 240), (5, 160)]
+
+# Re-encoded videos and album photos are downscaled by half, down to this size, until they fit the upload limit
+MIN_FALLBACK_DIMENSION = 240
+
+
+@functools.lru_cache(maxsize=None)
+def telegram_settings():
+    """ reads the .env file and the Telegram settings the first time a video is sent, not at startup """
+    from dotenv import load_dotenv
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    return {
+        "bot_token": os.getenv('TELEGRAM_BOT_TOKEN'),
+        "chat_id": os.getenv('TELEGRAM_CHAT_ID'),
+        # Bot API upload limit, raise it when using a local Bot API server
+        "upload_limit_mb": float(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', "50")),
+    }
 
 
 class CombineAndSendToTelegram:
@@ -27,6 +57,14 @@ class CombineAndSendToTelegram:
             "optional": {
                 "bot_token": ("STRING", {"default": ""}),
                 "chat_id": ("STRING", {"default": ""}),
+                "keep_video": ("BOOLEAN", {"default": False}),
+                "async_delivery": ("BOOLEAN", {"default": False}),
+                "preset": (X264_PRESETS,),
+                "crf": ("INT", {"default": 23, "min": 0, "max": 51}),
+                "max_file_size_mb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 2000.0, "step": 0.5}),
+                "max_dimension": ("INT", {"default": 0, "min": 0, "max": 8192}),
+                "threads": ("INT", {"default": 0, "min": 0, "max": 64}),
+                "oversize_fallback": (OVERSIZE_FALLBACKS,),
             },
         }
 
@@ -37,67 +75,268 @@ class CombineAndSendToTelegram:
     OUTPUT_NODE = True
 
     @classmethod
-    def IS_CHANGED(s, images, fps, message, bot_token, chat_id):
+    def IS_CHANGED(s, images, fps, message, **kwargs):
         return float("NaN")  # Always process
 
-    def process_and_send(self, images, fps, message, bot_token="", chat_id=""):
+    def process_and_send(self, images, fps, message, bot_token="", chat_id="", keep_video=False, async_delivery=False,
+                         preset="medium", crf=23, max_file_size_mb=0.0, max_dimension=0, threads=0, oversize_fallback="reencode"):
+        from .telegram_delivery import get_delivery_worker
+
         ## if bot_token or chat_id is not set, 
         ## use the default values from the .env file
+        settings = telegram_settings()
         if bot_token == "":
-            bot_token = TELEGRAM_BOT_TOKEN
+            bot_token = settings["bot_token"]
         if chat_id == "":
-            chat_id = TELEGRAM_CHAT_ID
+            chat_id = settings["chat_id"]
+
+        encoder = {
+            "preset": preset,
+            "crf": crf,
+            "max_file_size_mb": max_file_size_mb,
+            "max_dimension": max_dimension,
+            "threads": threads,
+        }
 
-        # Convert tensor images to PIL images and save as temporary files
         temp_dir = tempfile.mkdtemp()
-        image_files = []
-        for i, img_tensor in enumerate(images):
-            img_np = img_tensor.cpu().numpy()
-            img_pil = Image.fromarray((img_np * 255).astype(np.uint8))
-            file_path = os.path.join(temp_dir, f"frame_{i:04d}.png")
-            img_pil.save(file_path)
-            image_files.append(file_path)
-
-        print(f"bot_token: {bot_token}")
-        print(f"chat_id: {chat_id}")
-
-        # Combine images into a video using ffmpeg
         output_file = os.path.join(temp_dir, "output.mp4")
+        try:
+            # Stream the frames straight into ffmpeg, no intermediate image files
+            with stage("telegram.encode") as timing:
+                self.encode_video(images, fps, output_file, encoder)
+                timing.add_bytes(os.path.getsize(output_file))
+
+            # Pick how to deliver, falling back when the video is over Telegram's upload limit
+            with stage("telegram.build_job"):
+                job = self.build_job(images, fps, message, chat_id, output_file, encoder, oversize_fallback)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        # The temporary files are cleaned up once sent, the video is only kept when asked for
+        job["bot_token"] = bot_token
+        job["cleanup"] = [] if keep_video else [temp_dir]
+
+        # Send to Telegram, either right here or from the background delivery worker
+        worker = get_delivery_worker()
+        if async_delivery:
+            worker.submit(job)
+        else:
+            worker.deliver(job)
+
+        return (output_file if keep_video else "",)
+
+    def build_job(self, images, fps, message, chat_id, output_file, encoder, oversize_fallback):
+        limit_mb = telegram_settings()["upload_limit_mb"]
+        limit = limit_mb * 1024 * 1024
+        video_job = {
+            "method": "sendVideo",
+            "data": {"chat_id": chat_id, "caption": message},
+            "files": {"video": output_file},
+        }
+        size = os.path.getsize(output_file)
+        if size <= limit or oversize_fallback == "none":
+            return video_job
+
+        print(f"Video is {size / 1024 / 1024:.1f} MB, over the {limit_mb} MB upload limit, using the '{oversize_fallback}' fallback")
+        temp_dir = os.path.dirname(output_file)
+
+        if oversize_fallback == "reencode":
+            # Encode again at the bitrate that fits the limit, with some headroom for the container
+            encoder = dict(encoder, max_file_size_mb=limit_mb * 0.95)
+            self.encode_video(images, fps, output_file, encoder)
+
+            # Rate control can still overshoot on short or very detailed clips, lower the resolution as a last resort
+            dimension = max(images.shape[1], images.shape[2])
+            if encoder["max_dimension"] > 0:
+                dimension = min(dimension, encoder["max_dimension"])
+            while os.path.getsize(output_file) > limit and dimension // 2 >= MIN_FALLBACK_DIMENSION:
+                dimension //= 2
+                print(f"Re-encoded video is still over the {limit_mb} MB upload limit, trying again at {dimension} pixels")
+                self.encode_video(images, fps, output_file, dict(encoder, max_dimension=dimension))
+            self.warn_if_over_limit(video_job["files"].values(), limit_mb)
+            return video_job
+
+        if oversize_fallback == "document":
+            # The upload limit applies to documents too, the file is sent as is
+            self.warn_if_over_limit([output_file], limit_mb)
+            return {
+                "method": "sendDocument",
+                "data": {"chat_id": chat_id, "caption": message},
+                "files": {"document": output_file},
+            }
+
+        if oversize_fallback == "animation":
+            gif_file = os.path.join(temp_dir, "output.gif")
+            for max_fps, max_dimension in GIF_STEPS:
+                if encoder["max_dimension"] > 0:
+                    max_dimension = min(max_dimension, encoder["max_dimension"])
+                self.encode_gif(output_file, gif_file, min(fps, max_fps), max_dimension)
+                if os.path.getsize(gif_file) <= limit:
+                    return {
+                        "method": "sendAnimation",
+                        "data": {"chat_id": chat_id, "caption": message},
+                        "files": {"animation": gif_file},
+                    }
+                print(f"GIF at {min(fps, max_fps)} fps and {max_dimension} pixels is {os.path.getsize(gif_file) / 1024 / 1024:.1f} MB, over the {limit_mb} MB upload limit")
+
+            # Even the smallest GIF is too big, a photo album always fits
+            print("Sending an album of photos instead of the GIF")
+
+        # An album of evenly spaced frames
+        return self.build_photo_album(images, message, chat_id, temp_dir, limit_mb)
+
+    def build_photo_album(self, images, message, chat_id, temp_dir, limit_mb):
+        from PIL import Image
+
+        frame_count, height, width = images.shape[0], images.shape[1], images.shape[2]
+        count = min(frame_count, MAX_ALBUM_PHOTOS)
+        picks = sorted(set(round(i * (frame_count - 1) / max(1, count - 1)) for i in range(count)))
+        frames = [Image.fromarray((images[frame_index, ..., :3] * 255).clamp(0, 255).to(torch.uint8).cpu().numpy()) for frame_index in picks]
+
+        # Very large frames are halved until the whole album fits the upload limit
+        dimension = max(width, height)
+        while True:
+            media, files = [], {}
+            for n, frame in enumerate(frames):
+                if dimension < max(width, height):
+                    frame = frame.resize(self.scaled_size(width, height, dimension), Image.LANCZOS)
+                path = os.path.join(temp_dir, f"photo_{n:02d}.jpg")
+                frame.save(path, quality=90)
+                files[f"photo{n}"] = path
+                media.append({"type": "photo", "media": f"attach://photo{n}"})
+
+            total = sum(os.path.getsize(path) for path in files.values())
+            if total <= limit_mb * 1024 * 1024 or dimension // 2 < MIN_FALLBACK_DIMENSION:
+                break
+            dimension //= 2
+        self.warn_if_over_limit(files.values(), limit_mb)
+
+        # A media group needs at least two items, a single frame goes out as a plain photo
+        if len(files) == 1:
+            return {
+                "method": "sendPhoto",
+                "data": {"chat_id": chat_id, "caption": message},
+                "files": {"photo": files["photo0"]},
+            }
+
+        media[0]["caption"] = message
+        return {
+            "method": "sendMediaGroup",
+            "data": {"chat_id": chat_id, "media": json.dumps(media)},
+            "files": files,
+        }
+
+    def warn_if_over_limit(self, paths, limit_mb):
+        size_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+        if size_mb > limit_mb:
+            print(f"Warning: the upload is still {size_mb:.1f} MB, over the {limit_mb} MB upload limit, Telegram will likely reject it")
+
+    def encode_video(self, images, fps, output_file, encoder):
+        self.encode_frames(images, fps, output_file, encoder)
+
+        # Single pass rate control can overshoot, so tighten the target by the overshoot and try again
+        target_mb = encoder["max_file_size_mb"]
+        for _ in range(SIZE_TARGET_RETRIES):
+            size_mb = os.path.getsize(output_file) / 1024 / 1024
+            if target_mb <= 0 or size_mb <= encoder["max_file_size_mb"]:
+                break
+            target_mb *= encoder["max_file_size_mb"] / size_mb * 0.95
+            self.encode_frames(images, fps, output_file, dict(encoder, max_file_size_mb=target_mb))
+
+    def encode_frames(self, images, fps, output_file, encoder):
+        frame_count, height, width = images.shape[0], images.shape[1], images.shape[2]
+
+        # Raw RGB24 frames on stdin, encoded as they arrive
         ffmpeg_cmd = [
             "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", f"{width}x{height}",
             "-framerate", str(fps),
-            "-i", os.path.join(temp_dir, "frame_%04d.png"),
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
-            output_file
+            "-i", "-",
         ]
-        subprocess.run(ffmpeg_cmd, check=True)
+        ffmpeg_cmd += self.encoder_args(width, height, frame_count / fps, encoder)
+        ffmpeg_cmd += [output_file]
+        process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        # Convert and write the frames on a background thread while ffmpeg encodes
+        writer_error = []
+        writer = threading.Thread(target=self.write_frames, args=(images, process.stdin, writer_error), daemon=True)
+        writer.start()
 
-        # Send video to Telegram
-        url = f"https://api.telegram.org/bot{bot_token}/sendVideo"
-        with open(output_file, "rb") as video_file:
-            files = {"video": video_file}
-            data = {"chat_id": chat_id, "caption": message}
-            response = requests.post(url, files=files, data=data)
+        # Drain stderr here, so a chatty ffmpeg can never block on a full pipe
+        stderr = process.stderr.read()
+        process.wait()
+        writer.join()
 
-        # Clean up temporary files
-        for file in image_files:
-            os.remove(file)
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}: {stderr.decode(errors='replace').strip()}")
+        if writer_error:
+            raise writer_error[0]
+        print(f"Encoded {frame_count} frames to {output_file} ({os.path.getsize(output_file) / 1024 / 1024:.1f} MB)")
 
-        if response.status_code == 200:
-            print("Video sent successfully to Telegram!")
+    def encoder_args(self, width, height, duration, encoder):
+        args = ["-c:v", "libx264", "-preset", encoder["preset"]]
+
+        if encoder["max_file_size_mb"] > 0:
+            # Average bitrate that lands the whole clip under the target size
+            kbps = max(1, int(encoder["max_file_size_mb"] * 1024 * 1024 * 8 * 0.97 / duration / 1000))
+            args += ["-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{2 * kbps}k"]
         else:
-            print(f"Failed to send video. Status code: {response.status_code}")
-            print(f"Response: {response.text}")
+            args += ["-crf", str(encoder["crf"])]
+
+        if encoder["threads"] > 0:
+            args += ["-threads", str(encoder["threads"])]
+
+        # Optional downscale, yuv420p also needs even dimensions
+        scaled_width, scaled_height = self.scaled_size(width, height, encoder["max_dimension"])
+        if (scaled_width, scaled_height) != (width, height):
+            args += ["-vf", f"scale={scaled_width}:{scaled_height}:flags=area"]
+
+        return args + ["-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+
+    def scaled_size(self, width, height, max_dimension):
+        scale = min(1.0, max_dimension / max(width, height)) if max_dimension > 0 else 1.0
+        return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+    def encode_gif(self, video_file, gif_file, fps, max_dimension):
+        # A palette per clip keeps the colours
+        ffmpeg_cmd = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-i", video_file,
+            "-vf", f"fps={fps},scale='min({max_dimension},iw)':-2:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse",
+            gif_file
+        ]
+        subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL)
 
-        return (output_file,)
+    def write_frames(self, images, stdin, writer_error):
+        try:
+            for start in range(0, images.shape[0], FRAMES_PER_WRITE):
+                frames = images[start:start + FRAMES_PER_WRITE, ..., :3]
+                frames = (frames * 255).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+                stdin.write(memoryview(np.ascontiguousarray(frames)))
+        except BrokenPipeError:
+            ## ffmpeg exited early, its exit code and stderr tell why
+            pass
+        except Exception as e:
+            writer_error.append(e)
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
 
     @classmethod
-    def IS_CHANGED(s, images, fps, message, bot_token, chat_id):
+    def IS_CHANGED(s, images, fps, message, **kwargs):
         return float("NaN")
 
     @classmethod
-    def VALIDATE_INPUTS(s, images, fps, message, bot_token="", chat_id=""):
+    def VALIDATE_INPUTS(s, images, fps, message, bot_token="", chat_id="", **kwargs):
         if not isinstance(fps, int) or fps < 1 or fps > 60:
             return "FPS must be an integer between 1 and 60"
         if not isinstance(message, str):
@@ -0,0 +1,125 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from contextlib import ExitStack
+
+import requests
+
+from .instrumentation import stage
+
+
+# Base URL of the Bot API, point it at a local stand-in server to test delivery
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', "https://api.telegram.org")
+
+
+class TelegramDeliveryWorker:
+    """ uploads to the Telegram Bot API from a background thread, with retries and a bounded queue """
+
+    def __init__(self, api_url=None, max_queue=8, max_retries=5, backoff=1.0, max_backoff=60.0, timeout=(10, 300)):
+        self.api_url = (api_url or TELEGRAM_API_URL).rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._local = threading.local()
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """ a requests.Session per thread, sessions aren't safe to share between the worker and synchronous sends """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def submit(self, job):
+        """ queues a job, blocks while the queue is full so pending videos can't pile up without bound """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name="telegram-delivery", daemon=True)
+                self._thread.start()
+        self.jobs.put(job)
+
+    def join(self):
+        """ waits until every queued job has been delivered or given up on """
+        self.jobs.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self.deliver(job)
+            except Exception as e:
+                print(f"Failed to deliver to Telegram: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def deliver(self, job):
+        """ sends a job and cleans up its files afterwards, returns the final response or raises when none was received """
+        try:
+            with stage("telegram.upload") as timing:
+                files = job.get("files", {})
+                timing.add_bytes(sum(os.path.getsize(path) for path in files.values()))
+                response = self.send(job["bot_token"], job["method"], job["data"], files)
+        finally:
+            for path in job.get("cleanup", []):
+                shutil.rmtree(path, ignore_errors=True)
+
+        if response.status_code == 200:
+            print(f"{job['method']} sent successfully to Telegram!")
+        else:
+            print(f"Failed to {job['method']}. Status code: {response.status_code}")
+            print(f"Response: {response.text}")
+        return response
+
+    def send(self, bot_token, method, data, files):
+        """ posts one Bot API call, retrying on rate limits, server errors and network errors """
+        url = f"{self.api_url}/bot{bot_token}/{method}"
+        response, error = None, None
+        for attempt in range(self.max_retries + 1):
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            try:
+                with ExitStack() as stack:
+                    opened = {field: stack.enter_context(open(path, "rb")) for field, path in files.items()}
+                    response = self.session.post(url, data=data, files=opened, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Telegram request failed ({e}), attempt {attempt + 1} of {self.max_retries + 1}")
+                response, error = None, e
+            else:
+                if response.status_code == 429:
+                    # Telegram tells us how long to back off for
+                    delay = max(delay, self.retry_after(response))
+                elif response.status_code < 500:
+                    return response
+
+            if attempt < self.max_retries:
+                time.sleep(delay)
+
+        # Every attempt failed without an answer, let the caller know instead of pretending it was sent
+        if response is None:
+            raise error
+        return response
+
+    @staticmethod
+    def retry_after(response):
+        try:
+            return float(response.json().get("parameters", {}).get("retry_after", 0))
+        except (ValueError, AttributeError):
+            return 0.0
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_delivery_worker():
+    """ the worker shared by every Telegram node in the process """
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = TelegramDeliveryWorker()
+        return _worker